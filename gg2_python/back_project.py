@@ -3,13 +3,38 @@ import math
 import scipy
 from scipy import interpolate
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
+# sub-images no larger than this (in pixels) are back-projected directly
+# by the hierarchical method
+LEAF_SIZE = 16
 
-def back_project(sinogram, skip=1):
+
+def back_project(sinogram, skip=1, method=None, accuracy=None, workers=None):
     """back_project back-projection to reconstruct CT data
     back_project(sinogram) back-projects the filtered sinogram
     (angles x samples) to create the reconstruted data (samples x
-    samples)"""
+    samples)
+
+    back_project(sinogram, skip, method, accuracy) can be used to
+    specify how the data is back-projected. Possible options are:
+    'direct' - interpolate and sum every angle over the whole image
+               (default)
+    'hierarchical' - fast O(n^2 log n) hierarchical back-projection,
+                     see hierarchical_back_project, with accuracy
+                     controlling how far the angles are decimated
+
+    back_project(sinogram, skip, method, accuracy, workers) splits the
+    image into bands of rows which are back-projected on workers threads
+    at once, giving exactly the same result as a single thread."""
+
+    if method is None:
+        method = 'direct'
+
+    if method == 'hierarchical':
+        return hierarchical_back_project(sinogram, skip, accuracy, workers)
+    elif method != 'direct':
+        raise ValueError('unknown back-projection method ' + str(method))
 
     # get input dimensions
     ns = sinogram.shape[1]
@@ -18,12 +43,37 @@ def back_project(sinogram, skip=1):
 
     # zero output and form input coordinates
     # these have centre in the middle of the image
-    reconstruction = np.zeros((n, n))
     xi, yi = np.meshgrid(np.arange(0, ns, skip) - (ns / 2), np.arange(0, ns, skip) - (ns / 2))
 
+    if (workers is None) or (workers <= 1):
+        reconstruction = _back_project_direct(sinogram, xi, yi, True)
+    else:
+        # each thread fills its own band of rows, so no locking is needed
+        bands = np.array_split(np.arange(n), min(workers * 4, n))
+        bands = [b for b in bands if len(b) > 0]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(lambda b: _back_project_direct(sinogram, xi[b], yi[b], False), bands)
+            reconstruction = np.concatenate(list(results), axis=0)
+
+    # ensure any data outside the reconstructed circle is set to invalid
+    reconstruction[np.where((xi ** 2 + yi ** 2) > (ns / 2) ** 2)] = -1
+
+    sys.stdout.write("\n")
+
+    return reconstruction
+
+
+def _back_project_direct(sinogram, xi, yi, progress=False):
+    """back-project every angle of sinogram onto the pixels at xi, yi"""
+
+    ns = sinogram.shape[1]
+    angles = sinogram.shape[0]
+    reconstruction = np.zeros(xi.shape)
+
     # back project over each angle in turn
     for angle in range(angles):
-        sys.stdout.write("Reconstructing angle: %d   \r" % (angle + 1))
+        if progress:
+            sys.stdout.write("Reconstructing angle: %d   \r" % (angle + 1))
 
         # Form rotated coordinates for output interpolation
         # the rotation is about the middle of the image,
@@ -37,9 +87,334 @@ def back_project(sinogram, skip=1):
                                         assume_sorted=True, bounds_error=False, fill_value=0, axis=0)
         reconstruction = reconstruction + x2(x0) * (math.pi / angles)
 
+    return reconstruction
+
+
+def hierarchical_back_project(sinogram, skip=1, accuracy=None, workers=None):
+    """hierarchical_back_project fast back-projection to reconstruct CT data
+    hierarchical_back_project(sinogram, skip) back-projects the filtered
+    sinogram (angles x samples) in the same way as back_project, but
+    recursively splits the image into four sub-images. Each sub-image only
+    needs the part of the sinogram which passes through it, and because it
+    is smaller it also needs fewer angles, so adjacent angles are merged
+    as the sub-images shrink (Basu and Bresler). This reduces the cost from
+    O(angles n^2) to O(n^2 log n).
+
+    hierarchical_back_project(sinogram, skip, accuracy) sets how many angles
+    are kept for each sub-image, as a multiple of the number of samples
+    across its diagonal. The default of 1.0 is close to the direct method,
+    higher values are more accurate and slower, and lower values are
+    faster and blurrier.
+
+    hierarchical_back_project(sinogram, skip, accuracy, workers) back-projects
+    the sub-images on workers threads at once."""
+
+    if accuracy is None:
+        accuracy = 1.0
+
+    # get input dimensions
+    ns = sinogram.shape[1]
+    angles = sinogram.shape[0]
+    n = int(math.floor((ns - 1) // skip) + 1)
+
+    # output coordinates, with centre in the middle of the image
+    coords = np.arange(0, ns, skip) - (ns / 2)
+    p = math.pi / 2 + np.arange(angles) * math.pi / angles
+
+    # each row of a sub-image's sinogram holds samples at offset + j from
+    # the projection of the sub-image centre, starting here with the whole
+    # image. Multiply by dtheta now, so that merged angles can just be summed
+    centre = (coords[0] + coords[-1]) / 2
+    offsets = -(centre * np.cos(p) - centre * np.sin(p) + (ns / 2))
+    rows = sinogram * (math.pi / angles)
+
+    print('Hierarchical back-projection...')
+
+    reconstruction = np.zeros((n, n))
+    if (workers is None) or (workers <= 1):
+        _back_project_block(reconstruction, coords, coords, 0, n, 0, n, rows, offsets, p, centre, centre, accuracy)
+    else:
+        # split until there are several sub-images for each thread, which
+        # then each fill their own part of the image
+        blocks = [(0, n, 0, n, rows, offsets, p, centre, centre)]
+        while len(blocks) < workers * 4:
+            split = []
+            for block in blocks:
+                if max(block[1] - block[0], block[3] - block[2]) <= LEAF_SIZE:
+                    split.append(block)
+                else:
+                    split.extend(_split_block(coords, coords, *block, accuracy))
+            if len(split) == len(blocks):
+                break
+            blocks = split
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(lambda b: _back_project_block(reconstruction, coords, coords, *b, accuracy), blocks))
+
     # ensure any data outside the reconstructed circle is set to invalid
+    xi, yi = np.meshgrid(coords, coords)
     reconstruction[np.where((xi ** 2 + yi ** 2) > (ns / 2) ** 2)] = -1
 
-    sys.stdout.write("\n")
+    return reconstruction
+
+
+def back_project_roi(sinogram, centre, fov, matrix=None, pixel=None, method=None, accuracy=None):
+    """back_project_roi back-projection of a region of interest
+    back_project_roi(sinogram, centre, fov, matrix) back-projects the
+    filtered sinogram (angles x samples) onto a square region of interest
+    only, returning an image of (matrix x matrix) pixels. centre is the
+    (x, y) centre of the region and fov is its width, both in samples and
+    measured in the same way as the output of back_project, so that for an
+    even number of samples, centre=(-0.5, -0.5), fov=samples and
+    matrix=samples gives the same image as back_project.
+
+    back_project_roi(sinogram, centre, fov, pixel=pixel) instead gives the
+    output pixel size (in samples), and the matrix is chosen to cover fov.
+
+    Only the sinogram samples which pass through the region are used, so
+    the cost depends on the output matrix and not on the full field.
+    method and accuracy are as for back_project."""
+
+    if method is None:
+        method = 'direct'
+    if method not in ['direct', 'hierarchical']:
+        raise ValueError('unknown back-projection method ' + str(method))
+
+    if matrix is None:
+        if pixel is None:
+            raise ValueError('one of matrix or pixel must be given')
+        matrix = int(math.ceil(fov / pixel))
+
+    angles = sinogram.shape[0]
+    p = math.pi / 2 + np.arange(angles) * math.pi / angles
+
+    return _back_project_region(sinogram * (math.pi / angles), p, centre, fov, matrix, method, accuracy)
+
+
+def back_project_preview(sinogram, centre=None, fov=None, matrix=None, levels=3, method=None, accuracy=None):
+    """back_project_preview coarse-to-fine back-projection
+    for image in back_project_preview(sinogram): ... yields a series of
+    reconstructions of the filtered sinogram (angles x samples), starting
+    with a quick low resolution image and doubling the resolution each
+    time, for the given number of levels. Coarser levels use
+    correspondingly fewer angles, so the first preview costs a small
+    fraction of the final image, which is the same as back_project_roi.
+
+    centre, fov and matrix give the region of interest, as for
+    back_project_roi, and default to the full image."""
+
+    ns = sinogram.shape[1]
+    angles = sinogram.shape[0]
+
+    if centre is None:
+        centre = (-0.5, -0.5)
+    if fov is None:
+        fov = ns
+    if matrix is None:
+        matrix = ns
+
+    for level in reversed(range(levels)):
+        step = 2 ** level
+
+        if step == 1:
+            yield back_project_roi(sinogram, centre, fov, matrix, method=method, accuracy=accuracy)
+            continue
+
+        # use every step-th angle, and a matrix reduced by the same amount
+        p = math.pi / 2 + np.arange(0, angles, step) * math.pi / angles
+        rows = sinogram[0::step] * (step * math.pi / angles)
+        size = max(int(math.ceil(matrix / step)), 1)
+
+        yield _back_project_region(rows, p, centre, fov, size, method, accuracy)
+
+
+def back_project_angles(rows, angle_indices, angles, skip=1, method=None, accuracy=None):
+    """back_project_angles back-projection of a subset of angles
+    back_project_angles(rows, angle_indices, angles) back-projects the
+    filtered rows (len(angle_indices) x samples), which are the given angle
+    indices out of a scan of angles, and returns their contribution to the
+    output of back_project(sinogram, skip). Summing this over batches which
+    cover every angle gives back_project's output, except that the area
+    outside the reconstructed circle is left as it is rather than set to -1.
+    method and accuracy are as for back_project."""
+
+    angle_indices = np.asarray(angle_indices)
+    if rows.ndim != 2 or rows.shape[0] != len(angle_indices):
+        raise ValueError('input rows has different number of angles to input angle_indices')
+
+    # keep the angles in order, so hierarchical decimation merges neighbours
+    order = np.argsort(angle_indices)
+    rows = rows[order]
+    p = math.pi / 2 + angle_indices[order] * math.pi / angles
+
+    # the same output grid as back_project
+    ns = rows.shape[1]
+    n = int(math.floor((ns - 1) // skip) + 1)
+    centre = (n - 1) * skip / 2 - (ns / 2)
+
+    return _back_project_region(rows * (math.pi / angles), p, (centre, centre), n * skip, n, method, accuracy,
+                                mask=False)
+
+
+def _back_project_region(rows, p, centre, fov, matrix, method, accuracy, mask=True):
+    """back-project rows (angles p, already multiplied by dtheta) onto a
+    (matrix x matrix) region of width fov around centre"""
+
+    if method is None:
+        method = 'direct'
+    if accuracy is None:
+        accuracy = 1.0
+
+    # pixel centres of the output, relative to the middle of the full image
+    ns = rows.shape[1]
+    pixel = fov / matrix
+    xs = centre[0] + (np.arange(matrix) - (matrix - 1) / 2) * pixel
+    ys = centre[1] + (np.arange(matrix) - (matrix - 1) / 2) * pixel
+    radius = math.hypot(xs[-1] - xs[0], ys[-1] - ys[0]) / 2
+
+    # sample j of each row is at offset + j from the projection of the centre
+    offsets = -(centre[0] * np.cos(p) - centre[1] * np.sin(p) + (ns / 2))
+
+    reconstruction = np.zeros((matrix, matrix))
+    if method == 'hierarchical':
+
+        # only keep the samples of each row which pass through the region
+        rows, offsets = _crop_rows(rows, offsets, p, centre[0], centre[1], centre[0], centre[1], radius)
+        rows, offsets, p = _decimate(rows, offsets, p, accuracy * 2 * radius)
+        _back_project_block(reconstruction, xs, ys, 0, matrix, 0, matrix, rows, offsets, p,
+                            centre[0], centre[1], accuracy)
+    else:
+
+        # interpolation only reads the samples which pass through the region,
+        # and is zero outside the sinogram, as in back_project
+        reconstruction += _back_project_leaf(rows, offsets, p, xs - centre[0], ys - centre[1], strict=True)
+
+    # ensure any data outside the reconstructed circle is set to invalid
+    if mask:
+        xi, yi = np.meshgrid(xs, ys)
+        reconstruction[np.where((xi ** 2 + yi ** 2) > (ns / 2) ** 2)] = -1
 
     return reconstruction
+
+
+def _back_project_block(reconstruction, xs, ys, r0, r1, c0, c1, rows, offsets, p, cx, cy, accuracy):
+    """back-project rows (angles p) into reconstruction[r0:r1, c0:c1],
+    whose pixel centres are xs[c0:c1] and ys[r0:r1], centred at (cx, cy)"""
+
+    if max(r1 - r0, c1 - c0) <= LEAF_SIZE:
+
+        # small enough to back-project every remaining angle directly
+        reconstruction[r0:r1, c0:c1] += _back_project_leaf(rows, offsets, p, xs[c0:c1] - cx, ys[r0:r1] - cy)
+        return
+
+    for block in _split_block(xs, ys, r0, r1, c0, c1, rows, offsets, p, cx, cy, accuracy):
+        _back_project_block(reconstruction, xs, ys, *block, accuracy)
+
+
+def _split_block(xs, ys, r0, r1, c0, c1, rows, offsets, p, cx, cy, accuracy):
+    """split reconstruction[r0:r1, c0:c1], centred at (cx, cy), into (up to)
+    four sub-images, each with the cropped and decimated rows, offsets and
+    angles it needs, and its centre, as arguments for _back_project_block"""
+
+    blocks = []
+    rm = (r0 + r1) // 2 if r1 - r0 > 1 else r1
+    cm = (c0 + c1) // 2 if c1 - c0 > 1 else c1
+    for (sr0, sr1) in [(r0, rm), (rm, r1)]:
+        for (sc0, sc1) in [(c0, cm), (cm, c1)]:
+            if sr1 <= sr0 or sc1 <= sc0:
+                continue
+
+            # sub-image centre, and radius in samples
+            scx = (xs[sc0] + xs[sc1 - 1]) / 2
+            scy = (ys[sr0] + ys[sr1 - 1]) / 2
+            radius = math.hypot(xs[sc1 - 1] - xs[sc0], ys[sr1 - 1] - ys[sr0]) / 2
+
+            sub_rows, sub_offsets = _crop_rows(rows, offsets, p, cx, cy, scx, scy, radius)
+
+            # merge adjacent angles while there are more than the sub-image needs
+            sub_rows, sub_offsets, sub_p = _decimate(sub_rows, sub_offsets, p, accuracy * 2 * radius)
+
+            blocks.append((sr0, sr1, sc0, sc1, sub_rows, sub_offsets, sub_p, scx, scy))
+
+    return blocks
+
+
+def _back_project_leaf(rows, offsets, p, x, y, strict=False):
+    """directly back-project rows (angles p) onto pixel centres x and y,
+    given relative to the centre that offsets refer to. strict is as for
+    _sample_rows"""
+
+    image = np.zeros((len(y), len(x)))
+
+    # work through the angles in blocks, to limit the memory used
+    block = max(1, 4000000 // (len(x) * len(y)))
+    for a in range(0, len(p), block):
+        cosp = np.cos(p[a:a + block])[:, np.newaxis, np.newaxis]
+        sinp = np.sin(p[a:a + block])[:, np.newaxis, np.newaxis]
+        u = x[np.newaxis, np.newaxis, :] * cosp - y[np.newaxis, :, np.newaxis] * sinp
+        u = u - offsets[a:a + block, np.newaxis, np.newaxis]
+        image += np.sum(_sample_rows(rows[a:a + block], u, strict), axis=0)
+
+    return image
+
+
+def _crop_rows(rows, offsets, p, cx, cy, scx, scy, radius):
+    """cut out the part of each row (centred at (cx, cy)) which covers a
+    circle of the given radius around (scx, scy). The start is a whole
+    number of samples, so no interpolation is needed, and the fractional
+    part moves into the returned offsets"""
+
+    shift = (scx - cx) * np.cos(p) - (scy - cy) * np.sin(p)
+    start = np.floor(-math.ceil(radius) - 1 + shift - offsets)
+    length = 2 * math.ceil(radius) + 4
+    sub_rows = _sample_rows(rows, start[:, np.newaxis] + np.arange(length)[np.newaxis, :])
+    sub_offsets = start + offsets - shift
+
+    return sub_rows, sub_offsets
+
+
+def _decimate(rows, offsets, p, required):
+    """halve the number of angles by summing adjacent pairs, for as long as
+    at least required angles would remain"""
+
+    while rows.shape[0] > 1 and (rows.shape[0] + 1) // 2 >= required:
+
+        # an odd angle out is paired with an empty row
+        if rows.shape[0] % 2 == 1:
+            rows = np.concatenate((rows, np.zeros((1, rows.shape[1]))))
+            offsets = np.append(offsets, offsets[-1])
+            p = np.append(p, p[-1])
+
+        # resample the second of each pair onto the samples of the first
+        index = (offsets[0::2] - offsets[1::2])[:, np.newaxis] + np.arange(rows.shape[1])[np.newaxis, :]
+        rows = rows[0::2] + _sample_rows(rows[1::2], index)
+        offsets = offsets[0::2]
+        p = (p[0::2] + p[1::2]) / 2
+
+    return rows, offsets, p
+
+
+def _sample_rows(rows, index, strict=False):
+    """linearly interpolate each row of rows (angles x samples) at the
+    fractional sample positions in index (angles x ...), with zero outside.
+    If strict, positions beyond the first or last sample are zero, as for
+    interp1d, rather than tapering to zero over one sample"""
+
+    shape = index.shape
+    index = index.reshape(shape[0], -1)
+
+    # pad with zeros either side, so clipped indices fall onto zero
+    samples = rows.shape[1]
+    padded = np.pad(rows, ((0, 0), (1, 1)), mode='constant')
+
+    i0 = np.floor(index)
+    f = index - i0
+    i0 = i0.astype(int) + 1
+    a = np.take_along_axis(padded, np.clip(i0, 0, samples + 1), axis=1)
+    b = np.take_along_axis(padded, np.clip(i0 + 1, 0, samples + 1), axis=1)
+
+    values = a + f * (b - a)
+    if strict:
+        values[(index < 0) | (index > samples - 1)] = 0
+
+    return values.reshape(shape)
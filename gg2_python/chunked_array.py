@@ -0,0 +1,255 @@
+import numpy as np
+import json
+import math
+import os
+import zlib
+
+INDEX_FILE = 'index.json'
+
+
+class ChunkedArray(object):
+    def __init__(self, path, shape=None, dtype=None, chunks=None, compression=None):
+        """x = ChunkedArray(path) opens the chunked array stored in the directory
+        path, and x = ChunkedArray(path, shape, dtype, chunks, compression)
+        creates a new one. The array is split into blocks of size chunks, each
+        stored in its own file, with a JSON index holding the shape, dtype, chunk
+        size and compression. This allows arrays larger than memory, such as
+        sinograms and volumes of Xtreme data, to be written and read a piece at a
+        time.
+
+        chunks defaults to single slices along the first dimension. compression
+        can be None, so that chunks are stored as .npy files and are memory-mapped
+        when read, or 'zlib' for lossless compression, which works well for int16
+        and float32 data as the bytes of each value are grouped first.
+
+        Each chunk is written independently, so separate processes (workers) can
+        open the same path and write different chunks in parallel. Chunks which
+        have not been written read as zero, and missing_chunks() lists them so
+        that an interrupted pipeline can carry on where it left off.
+
+        Indexing with integers and slices reads (x[10], x[:, 5:8]) or writes
+        (x[10] = y) just the chunks involved.
+
+        Creating an array with the same shape, dtype, chunks and compression as
+        the one already at path keeps its chunks, so a pipeline can be resumed,
+        but any other existing array at path is replaced, deleting its chunks."""
+
+        self.path = path
+        index_file = os.path.join(path, INDEX_FILE)
+
+        if shape is None:
+            if not os.path.exists(index_file):
+                raise ValueError('chunked array ' + path + ' does not exist')
+
+            with open(index_file, 'r') as f:
+                index = json.load(f)
+            shape = index['shape']
+            dtype = index['dtype']
+            chunks = index['chunks']
+            compression = index['compression']
+
+        else:
+            if dtype is None:
+                dtype = np.float64
+            if chunks is None:
+                chunks = [1] + list(shape[1:])
+            if len(chunks) != len(shape):
+                raise ValueError('chunks must have the same number of dimensions as shape')
+            if compression not in [None, 'zlib']:
+                raise ValueError('unknown compression ' + str(compression))
+
+            if not os.path.exists(path):
+                os.makedirs(path)
+
+            index = {'shape': [int(s) for s in shape], 'dtype': np.dtype(dtype).str,
+                     'chunks': [int(c) for c in chunks], 'compression': compression}
+
+            # old chunks are only valid for the same layout
+            if os.path.exists(index_file):
+                with open(index_file, 'r') as f:
+                    old = json.load(f)
+                if old != index:
+                    for name in os.listdir(path):
+                        if name.startswith('c') and (name.endswith('.npy') or name.endswith('.zlib')
+                                                     or name.endswith('.tmp')):
+                            os.remove(os.path.join(path, name))
+
+            _write_atomic(index_file, json.dumps(index).encode())
+
+        self.shape = tuple(int(s) for s in shape)
+        self.dtype = np.dtype(dtype)
+        self.chunks = tuple(int(c) for c in chunks)
+        self.compression = compression
+        self.ndim = len(self.shape)
+        self.grid = tuple(int(math.ceil(s / c)) for (s, c) in zip(self.shape, self.chunks))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def chunk_file(self, index):
+        """file name for the chunk with the given grid index"""
+
+        name = 'c' + '.'.join(str(i) for i in index)
+        if self.compression is None:
+            return os.path.join(self.path, name + '.npy')
+        else:
+            return os.path.join(self.path, name + '.' + self.compression)
+
+    def chunk_shape(self, index):
+        """shape of the chunk with the given grid index, which is smaller than
+        chunks at the far edges of the array"""
+
+        return tuple(min(c, s - i * c) for (i, c, s) in zip(index, self.chunks, self.shape))
+
+    def all_chunks(self):
+        """list of the grid index of every chunk"""
+
+        return [tuple(int(i) for i in index) for index in np.ndindex(*self.grid)]
+
+    def chunk_exists(self, index):
+        return os.path.exists(self.chunk_file(index))
+
+    def missing_chunks(self):
+        """list of the grid index of every chunk which has not been written"""
+
+        return [index for index in self.all_chunks() if not self.chunk_exists(index)]
+
+    def write_chunk(self, index, data):
+        """write the whole chunk with the given grid index"""
+
+        data = np.asarray(data, dtype=self.dtype)
+        if data.shape != self.chunk_shape(index):
+            raise ValueError('chunk ' + str(index) + ' must be of size ' + str(self.chunk_shape(index)))
+
+        if self.compression is None:
+            temp = self.chunk_file(index) + '.tmp.npy'
+            np.save(temp, data)
+            os.replace(temp, self.chunk_file(index))
+        else:
+            _write_atomic(self.chunk_file(index), zlib.compress(_shuffle(data), 6))
+
+    def read_chunk(self, index, mmap=True):
+        """read the chunk with the given grid index, which is zero if it has not
+        been written. Uncompressed chunks are memory-mapped unless mmap is False"""
+
+        if not self.chunk_exists(index):
+            return np.zeros(self.chunk_shape(index), dtype=self.dtype)
+
+        shape = self.chunk_shape(index)
+        if self.compression is None:
+            data = np.load(self.chunk_file(index), mmap_mode='r' if mmap else None)
+            if (data.shape != shape) or (data.dtype != self.dtype):
+                raise ValueError('chunk ' + str(index) + ' does not match the array, ' + str(data.shape) + ' ' +
+                                 str(data.dtype) + ' instead of ' + str(shape) + ' ' + str(self.dtype))
+            return data
+
+        with open(self.chunk_file(index), 'rb') as f:
+            raw = zlib.decompress(f.read())
+        if len(raw) != int(np.prod(shape)) * self.dtype.itemsize:
+            raise ValueError('chunk ' + str(index) + ' does not match the array size ' + str(shape) + ' ' +
+                             str(self.dtype))
+
+        return _unshuffle(raw, self.dtype, shape)
+
+    def __getitem__(self, key):
+        ranges, squeeze = self._ranges(key)
+        out = np.zeros(tuple(stop - start for (start, stop) in ranges), dtype=self.dtype)
+
+        for index, source, target in self._overlaps(ranges):
+            out[target] = self.read_chunk(index)[source]
+
+        return out[tuple(0 if s else slice(None) for s in squeeze)]
+
+    def __setitem__(self, key, value):
+        ranges, squeeze = self._ranges(key)
+        shape = tuple(stop - start for (start, stop) in ranges)
+        value = np.asarray(value, dtype=self.dtype)
+
+        # put back any dimensions removed by integer indices
+        if value.ndim == squeeze.count(False):
+            value = value.reshape([1 if s else n for (s, n) in zip(squeeze, shape)])
+        value = np.broadcast_to(value, shape)
+
+        for index, source, target in self._overlaps(ranges):
+            if all(s.stop - s.start == c for (s, c) in zip(source, self.chunk_shape(index))):
+                # whole chunk, so nothing needs to be read first
+                self.write_chunk(index, value[target])
+            else:
+                chunk = np.array(self.read_chunk(index))
+                chunk[source] = value[target]
+                self.write_chunk(index, chunk)
+
+    def _ranges(self, key):
+        """convert an index of integers and unit-step slices into a (start, stop)
+        range along every dimension, and whether that dimension is removed"""
+
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > self.ndim:
+            raise IndexError('too many indices for chunked array')
+        key = key + (slice(None),) * (self.ndim - len(key))
+
+        ranges = []
+        squeeze = []
+        for k, size in zip(key, self.shape):
+            if isinstance(k, slice):
+                start, stop, step = k.indices(size)
+                if step != 1:
+                    raise IndexError('chunked arrays only support slices with a step of one')
+                ranges.append((start, max(stop, start)))
+                squeeze.append(False)
+            else:
+                k = int(k)
+                if k < 0:
+                    k = k + size
+                if (k < 0) or (k >= size):
+                    raise IndexError('index ' + str(k) + ' is out of range')
+                ranges.append((k, k + 1))
+                squeeze.append(True)
+
+        return ranges, squeeze
+
+    def _overlaps(self, ranges):
+        """for every chunk overlapping ranges, give its grid index, the slices
+        within the chunk, and the slices within the requested block"""
+
+        grid_ranges = [range(start // c, (stop - 1) // c + 1) if stop > start else range(0)
+                       for ((start, stop), c) in zip(ranges, self.chunks)]
+
+        for index in np.ndindex(*[len(g) for g in grid_ranges]):
+            index = tuple(g[i] for (g, i) in zip(grid_ranges, index))
+            source = []
+            target = []
+            for (i, c, (start, stop)) in zip(index, self.chunks, ranges):
+                low = max(start, i * c)
+                high = min(stop, (i + 1) * c)
+                source.append(slice(low - i * c, high - i * c))
+                target.append(slice(low - start, high - start))
+            yield index, tuple(source), tuple(target)
+
+
+def _write_atomic(file_name, data):
+    """write bytes to a temporary file and then rename it, so that a partly
+    written file is never seen by other workers"""
+
+    temp = file_name + '.tmp'
+    with open(temp, 'wb') as f:
+        f.write(data)
+    os.replace(temp, file_name)
+
+
+def _shuffle(data):
+    """group the first bytes of every value together, then the second bytes and
+    so on, which compresses better for smoothly varying data"""
+
+    raw = np.ascontiguousarray(data).view(np.uint8).reshape(-1, data.dtype.itemsize)
+
+    return np.ascontiguousarray(raw.T).tobytes()
+
+
+def _unshuffle(raw, dtype, shape):
+    """undo _shuffle"""
+
+    raw = np.frombuffer(raw, dtype=np.uint8).reshape(dtype.itemsize, -1)
+
+    return np.ascontiguousarray(raw.T).view(dtype).reshape(shape)
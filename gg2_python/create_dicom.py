@@ -44,6 +44,7 @@ def create_dicom(x, filename, sp, sz=None, f=1, study_uid=None, series_uid=None,
 	x = np.clip(x, None, 4096)
 
 	file_meta = Dataset()
+	file_meta.TransferSyntaxUID = pydicom.uid.ImplicitVRLittleEndian
 
 	# Initial write to create DICOM file with default settings
 	full_filename = filename + '_' + str(f).zfill(4) + '.dcm'
@@ -106,8 +107,32 @@ def create_dicom(x, filename, sp, sz=None, f=1, study_uid=None, series_uid=None,
 	if x.dtype != np.uint16:
 		x = x.astype(np.uint16)
 
-	ds.PixelData = x.tostring()
+	ds.PixelData = x.tobytes()
 
 	# write final file with this metadata
 	ds.save_as(full_filename)
-	
\ No newline at end of file
+	
+
+def create_dicom_series(images, filename, sp, sz=None, storage_directory=None, first=1):
+
+	""" Create a DICOM series from a sequence of images
+
+	create_dicom_series(images, filename, sp, sz) writes each image in images
+	to its own DICOM file using create_dicom, with frame numbers counting up
+	from first (default 1) and a single study UID, series UID and time shared
+	by all of them. images can be a volume (slices x rows x columns), or any
+	iterable of images such as a generator, so that slices can be written as
+	they are reconstructed without holding the whole volume in memory.
+
+	Returns the number of frames written."""
+
+	study_uid = pydicom.uid.generate_uid()
+	series_uid = pydicom.uid.generate_uid()
+	time = datetime.datetime.now()
+
+	f = first
+	for x in images:
+		create_dicom(x, filename, sp, sz, f, study_uid, series_uid, time, storage_directory)
+		f = f + 1
+
+	return f - first
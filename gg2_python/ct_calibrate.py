@@ -10,11 +10,15 @@ def ct_calibrate(photons, material, sinogram, scale, correct=True):
     in x (angles x samples) and returns a linear attenuation sinogram
     (angles x samples). photons is the source energy distribution, material is the
     material structure containing names, linear attenuation coefficients and
-    energies in mev, and scale is the size of each pixel in x, in cm."""
+    energies in mev, and scale is the size of each pixel in x, in cm.
+
+    sinogram can also have leading axes, such as slices of a volume, and
+    photons can be a family of sources (configurations x energies) when the
+    sinogram has a leading configurations axis, as from ct_scan."""
 
     # Get dimensions and work out detection for just air of twice the side
     # length (has to be the same as in ct_scan.m)
-    n = sinogram.shape[1]
+    n = sinogram.shape[-1]
 
     # perform calibration, simulate with only air
     # Use ct_scan with an empty phantom, since it fills surrounding space with air
@@ -22,6 +26,10 @@ def ct_calibrate(photons, material, sinogram, scale, correct=True):
     calib_phantom.fill(material.name.index('Air'))
     calib_sinogram = ct_scan(photons, material, calib_phantom, scale, 1)
 
+    # one air scan for each source, shared by every other axis
+    configurations = np.shape(photons)[:-1]
+    calib_sinogram = calib_sinogram.reshape(configurations + (1,) * (sinogram.ndim - len(configurations) - 1) + (n,))
+
     attenuation = -np.log(sinogram/calib_sinogram)
 
     return attenuation
@@ -11,14 +11,18 @@ def ct_detect(p, coeffs, depth, mas=10000):
     in y (samples).
 
     mas defines the current-time-product which affects the noise distribution
-    for the linear attenuation"""
+    for the linear attenuation
+
+    p can also be a family of source distributions (configurations, energies),
+    such as from fake_sources, when y is (configurations, samples). The
+    attenuation of each energy is found once and shared by every configuration."""
 
     # check p for number of energies
     if type(p) != np.ndarray:
         p = np.array([p])
-    if p.ndim > 1:
-        raise ValueError('input p has more than one dimension')
-    energies = len(p)
+    if p.ndim > 2:
+        raise ValueError('input p has more than two dimensions')
+    energies = p.shape[-1]
 
     # check coeffs is of (materials, energies)
     if type(coeffs) != np.ndarray:
@@ -45,14 +49,25 @@ def ct_detect(p, coeffs, depth, mas=10000):
         raise ValueError('input depth has different number of materials to input coeffs')
     samples = depth.shape[1]
 
+    if p.ndim == 2:
+
+        # attenuation (energies, samples) of every material at once, then
+        # summed over energies for each configuration
+        attenuation = np.exp(-np.dot(coeffs.T, depth))
+        detector_photons = np.dot(p, attenuation)
+
+        return np.clip(detector_photons, 1, None)
+
     # extend source photon array so it covers all samples
     detector_photons = np.zeros([energies, samples])
     for e in range(energies):
         detector_photons[e] = p[e]
 
-    # calculate array of residual mev x samples for each material in turn
+    # calculate array of residual mev x samples for each material in turn,
+    # skipping any material which is not on any of the rays
     for m in range(materials):
-        detector_photons = photons(detector_photons, coeffs[m], depth[m])
+        if np.any(depth[m]):
+            detector_photons = photons(detector_photons, coeffs[m], depth[m])
 
     # sum this over energies
     detector_photons = np.sum(detector_photons, axis=0)
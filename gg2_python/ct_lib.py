@@ -1,6 +1,10 @@
 import matplotlib.pyplot as plt
 import numpy as np
 import os
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from chunked_array import ChunkedArray
 
 def draw(data, map='gray', caxis=None):
 	"""Draw an image"""
@@ -14,7 +18,8 @@ def plot(data):
 	plt.show()
 
 def save_draw(data, storage_directory, file_name, map='gray'):
-	"""save an image"""
+	"""save an image, with a colorbar. For saving many images use save_draw_stack
+	or save_montage, which do not create a figure for each image"""
 	create_figure(data, map)
 
 	full_path = get_full_path(storage_directory, file_name)
@@ -49,6 +54,36 @@ def load_numpy_array(storage_directory, file_name):
 
 	return np.load(full_path)
 
+def save_chunked_array(data, storage_directory, file_name, chunks=None, compression=None, workers=None):
+	"""save a numpy array as a chunked array, a directory of chunk files with a
+	JSON index, which can then be read a slice at a time. chunks defaults to
+	single slices along the first dimension, and compression can be None or
+	'zlib'. The chunks are written in parallel using workers threads."""
+
+	full_path = get_full_path(storage_directory, file_name)
+
+	store = ChunkedArray(full_path, data.shape, data.dtype, chunks, compression)
+
+	def write(index):
+		block = tuple(slice(i * c, (i + 1) * c) for (i, c) in zip(index, store.chunks))
+		store.write_chunk(index, data[block])
+
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		list(executor.map(write, store.all_chunks()))
+
+	return store
+
+def load_chunked_array(storage_directory, file_name):
+	"""open a chunked array saved by save_chunked_array, without reading it. The
+	result can be indexed like a numpy array to read just the slices needed"""
+
+	full_path = os.path.join(storage_directory, file_name)
+
+	if not os.path.exists(full_path):
+		raise Exception('File named ' + full_path + ' does not exist')
+
+	return ChunkedArray(full_path)
+
 def get_full_path(storage_directory, file_name):
 	#create storage_directory if needed
 	if not os.path.exists(storage_directory):
@@ -74,3 +109,125 @@ def create_figure(data, map, caxis = None):
 
 	#add colorbar
 	plt.colorbar(im, orientation='vertical')
+
+
+def save_draw_stack(data, storage_directory, file_name, map='gray', caxis=None, workers=None):
+	"""save each image in a stack (images x rows x columns) as a PNG file, named
+	file_name_0001.png and so on, without using matplotlib figures.
+
+	caxis gives the [min, max] display window for every image, otherwise each
+	image is scaled to its own range as in save_draw. The files are compressed
+	and written on a pool of workers threads. Returns the list of file paths."""
+
+	images = window_level(data, caxis)
+	lut = colormap_lut(map)
+
+	full_paths = [get_full_path(storage_directory, file_name + '_' + str(i + 1).zfill(4) + '.png') for i in range(len(images))]
+
+	with ThreadPoolExecutor(workers) as executor:
+		list(executor.map(lambda i: write_png(full_paths[i], images[i], lut), range(len(images))))
+
+	return full_paths
+
+
+def save_montage(data, storage_directory, file_name, map='gray', caxis=None, columns=None, workers=None):
+	"""save a stack of images (images x rows x columns) as montage sheets of
+	thumbnails, without using matplotlib figures. columns sets the number of
+	images across each sheet (default is square), and the sheets are named
+	file_name_0001.png and so on, holding columns x columns images each.
+	caxis and workers are as for save_draw_stack. Returns the list of file paths."""
+
+	images = window_level(data, caxis)
+	count, rows, cols = images.shape
+	if count == 0:
+		return []
+
+	if columns is None:
+		columns = int(np.ceil(np.sqrt(count)))
+	per_sheet = columns * columns
+
+	# pad to a whole number of sheets, then tile each sheet of images
+	sheets = int(np.ceil(count / per_sheet))
+	padded = np.zeros((sheets * per_sheet, rows, cols), dtype=np.uint8)
+	padded[:count] = images
+	padded = padded.reshape(sheets, columns, columns, rows, cols)
+	padded = padded.transpose(0, 1, 3, 2, 4).reshape(sheets, columns * rows, columns * cols)
+
+	# remove any rows of the last sheet which are all padding
+	used = int(np.ceil((count - (sheets - 1) * per_sheet) / columns))
+	montage = [padded[i] for i in range(sheets - 1)] + [padded[sheets - 1][:used * rows]]
+
+	lut = colormap_lut(map)
+	full_paths = [get_full_path(storage_directory, file_name + '_' + str(i + 1).zfill(4) + '.png') for i in range(sheets)]
+
+	with ThreadPoolExecutor(workers) as executor:
+		list(executor.map(lambda i: write_png(full_paths[i], montage[i], lut), range(sheets)))
+
+	return full_paths
+
+
+def window_level(data, caxis=None):
+	"""scale a stack of images (images x rows x columns), or a single image,
+	to uint8 display values. caxis gives the [min, max] window for every image,
+	otherwise each image is scaled between its own minimum and maximum"""
+
+	data = np.asarray(data, dtype=np.float32)
+	if data.ndim == 2:
+		data = data[np.newaxis]
+
+	if caxis is None:
+		low = np.nanmin(data, axis=(1, 2), keepdims=True)
+		high = np.nanmax(data, axis=(1, 2), keepdims=True)
+	else:
+		low = np.float32(caxis[0])
+		high = np.float32(caxis[1])
+
+	# avoid dividing by zero for flat images
+	width = np.maximum(high - low, np.finfo(np.float32).tiny)
+
+	scaled = (data - low) * (255 / width)
+	scaled[np.isnan(scaled)] = 0
+	np.clip(scaled, 0, 255, out=scaled)
+
+	return (scaled + 0.5).astype(np.uint8)
+
+
+def colormap_lut(map='gray'):
+	"""returns a (256 x 3) uint8 table of RGB values for the matplotlib colormap
+	named map, or None for 'gray', which is saved as a greyscale image"""
+
+	if map == 'gray':
+		return None
+
+	colours = plt.get_cmap(map)(np.arange(256))[:, :3]
+
+	return (colours * 255 + 0.5).astype(np.uint8)
+
+
+def write_png(full_path, image, lut=None):
+	"""write a uint8 image (rows x columns) to a PNG file, mapping it through
+	the (256 x 3) RGB table lut if given, and as greyscale otherwise"""
+
+	if lut is None:
+		pixels = image
+		colour_type = 0
+	else:
+		pixels = lut[image]
+		colour_type = 2
+
+	rows, cols = image.shape
+
+	# each row of the image data starts with a filter type byte, zero for none
+	raw = np.zeros((rows, 1 + pixels[0].size), dtype=np.uint8)
+	raw[:, 1:] = pixels.reshape(rows, -1)
+
+	def chunk(kind, body):
+		return struct.pack('>I', len(body)) + kind + body + struct.pack('>I', zlib.crc32(kind + body) & 0xffffffff)
+
+	header = struct.pack('>IIBBBBB', cols, rows, 8, colour_type, 0, 0, 0)
+
+	with open(full_path, 'wb') as f:
+		f.write(b'\x89PNG\r\n\x1a\n')
+		f.write(chunk(b'IHDR', header))
+		f.write(chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)))
+		f.write(chunk(b'IEND', b''))
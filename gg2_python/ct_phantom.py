@@ -3,21 +3,33 @@ import numpy.matlib
 import math
 
 
-def phantom(ellipses, n):
-    """generates an artificial phantom given ellipse parameters and size n"""
+def phantom(ellipses, n, slices=None):
+    """generates an artificial phantom given ellipse parameters and size n
+
+    If slices is given, this generates a (slices x n x n) volume instead, with
+    the same pixel size along z as across each slice. Each ellipse is then an
+    ellipsoid with two more parameters, its z semi-axis and z offset, which
+    default to infinity (a cylinder along z) and zero."""
 
     # convert to numpy array
-    ellipses = np.array(ellipses)
+    ellipses = np.array(ellipses, dtype=float)
 
     # handle both single ellipse and arrays of ellipses
     if len(ellipses.shape) == 1:
         ellipses = np.array([ellipses])
 
-    phantom_instance = np.zeros((n, n))
-
     xax = np.linspace(-1.0, 1.0, n, endpoint=True)
     xg = np.matlib.repmat(xax, n, 1)  # x coordinates, the y coordinates are rot90(xg)
 
+    if slices is None:
+        phantom_instance = np.zeros((n, n))
+    else:
+        phantom_instance = np.zeros((slices, n, n))
+        zax = (np.arange(slices) - (slices - 1) / 2) * (xax[1] - xax[0])
+        if ellipses.shape[1] < 8:
+            extra = np.tile([np.inf, 0], (len(ellipses), 1))[:, ellipses.shape[1] - 6:]
+            ellipses = np.concatenate((ellipses, extra), axis=1)
+
     for ellipse in ellipses:
         asq = ellipse[1] ** 2  # a^2
         bsq = ellipse[2] ** 2  # b^2
@@ -31,14 +43,16 @@ def phantom(ellipses, n):
         sinp = math.sin(phi)
         values = (((x_center * cosp + y_center * sinp) ** 2) / asq + ((y_center * cosp - x_center * sinp) ** 2) / bsq)
 
-        for index, element in np.ndenumerate(values):
-            if element <= 1:
-                phantom_instance[index] = phantom_instance[index] + a
+        if slices is not None:
+            # add the z term, which is the same across each slice
+            values = values[np.newaxis, :, :] + (((zax - ellipse[7]) / ellipse[6]) ** 2)[:, np.newaxis, np.newaxis]
+
+        phantom_instance[values <= 1] += a
 
     return phantom_instance
 
 
-def ct_phantom(names, n, type, metal='Titanium', point_offset=False):
+def ct_phantom(names, n, type, metal='Titanium', point_offset=False, slices=None):
     """ ct_phantom create phantom for CT scanning
         x = ct_phantom(names, n, type, metal) creates a CT phantom in x of
         size (n X n), and type given by type:
@@ -57,6 +71,12 @@ def ct_phantom(names, n, type, metal='Titanium', point_offset=False):
 
         The output x has data values which correspond to indices in the names
         array, which must also contain 'Air', 'Adipose', 'Soft Tissue' and 'Bone'.
+
+        x = ct_phantom(names, n, type, metal, point_offset, slices) creates a
+        (slices x n x n) volume instead, with the same pixel size along z. The
+        body, bones and calibration circle extend along z, the implants are
+        ellipsoids (the pins of type 7 are long along z), and the point of
+        type 2 is in the middle slice.
     """
 
     # Get material locations
@@ -70,17 +90,17 @@ def ct_phantom(names, n, type, metal='Titanium', point_offset=False):
 
         # simple circle for looking at calibration
         t = [1, 0.75, 0.75, 0.0, 0.0, 0]
-        x = phantom(t, n)
+        x = phantom(t, n, slices)
 
-        for index, value in np.ndenumerate(x):
-            if value >= 1:
-                x[index] = tissue
+        x[x >= 1] = tissue
 
     elif type == 2:
 
         # impulse for looking at resolution
         x = np.zeros((n, n))
         x[int(n / 2 + point_offset[0])][int(n / 2 + point_offset[1])] = tissue
+        if slices is not None:
+            x = np.stack([x if s == slices // 2 else np.zeros((n, n)) for s in range(slices)])
 
     else:
 
@@ -88,31 +108,25 @@ def ct_phantom(names, n, type, metal='Titanium', point_offset=False):
         t = [[1, 0.57, 0.52, -0.35, 0.1, 0],
              [1, 0.57, 0.52, 0.35, 0.1, 0],
              [1, 0.52, 0.45, 0, -0.08, 0]]
-        x = phantom(t, n)
+        x = phantom(t, n, slices)
 
-        for index, value in np.ndenumerate(x):
-            if value >= 1:
-                x[index] = tissue
+        x[x >= 1] = tissue
 
         a = [[1, 0.55, 0.5, -0.35, 0.1, 0],
              [1, 0.55, 0.5, 0.35, 0.1, 0],
              [1, 0.5, 0.43, 0, -0.08, 0]]
-        x = x + phantom(a, n)
+        x = x + phantom(a, n, slices)
 
-        for index, value in np.ndenumerate(x):
-            if value > tissue:
-                x[index] = adipose
+        x[x > tissue] = adipose
 
         t = [[1, 0.37, 0.35, -0.42, 0.03, 0],
              [1, 0.37, 0.35, 0.42, 0.03, 0],
              [1, 0.24, 0.16, -0.3, 0.28, 20],
              [1, 0.24, 0.16, 0.3, 0.28, -20],
              [1, 0.4, 0.2, 0, -0.15, 0]]
-        x = x + phantom(t, n)
+        x = x + phantom(t, n, slices)
 
-        for index, value in np.ndenumerate(x):
-            if value > adipose:
-                x[index] = tissue
+        x[x > adipose] = tissue
 
         b = [[1, 0.16, 0.12, -0.54, -0.01, 0],
              [-1, 0.11, 0.10, -0.53, -0.01, 0],
@@ -126,50 +140,45 @@ def ct_phantom(names, n, type, metal='Titanium', point_offset=False):
              [-1, 0.07, 0.06, 0.25, 0.25, -140],
              [1, 0.18, 0.05, 0.05, -0.15, -100],
              [-1, 0.14, 0.03, 0.05, -0.15, -100]]
-        x = x + phantom(b, n)
+        x = x + phantom(b, n, slices)
 
-        for index, value in np.ndenumerate(x):
-            if value > tissue:
-                x[index] = bone
+        x[x > tissue] = bone
 
         # this adds a metal implant
         if nmetal > tissue:
             if type == 3:
                 # single large hip replacement
-                m = [100, 0.1, 0.1, -0.48, -0.01, 0]
+                m = [100, 0.1, 0.1, -0.48, -0.01, 0, 0.1]
             elif type == 4:
                 # bilateral hip replacement
-                m = [[100, 0.1, 0.1, -0.48, -0.01, 0],
-                     [100, 0.08, 0.06, 0.48, 0, 0]]
+                m = [[100, 0.1, 0.1, -0.48, -0.01, 0, 0.1],
+                     [100, 0.08, 0.06, 0.48, 0, 0, 0.07]]
             elif type == 5:
                 # sphere with three satellites
-                m = [[100, 0.05, 0.05, -0.43, -0.03, 0],
-                     [100, 0.02, 0.02, -0.53, 0.04, 0],
-                     [100, 0.02, 0.02, -0.53, -0.10, 0],
-                     [100, 0.02, 0.02, -0.31, -0.03, 0]]
+                m = [[100, 0.05, 0.05, -0.43, -0.03, 0, 0.05],
+                     [100, 0.02, 0.02, -0.53, 0.04, 0, 0.02],
+                     [100, 0.02, 0.02, -0.53, -0.10, 0, 0.02],
+                     [100, 0.02, 0.02, -0.31, -0.03, 0, 0.02]]
             elif type == 6:
                 # disc and other sphere
-                m = [[100, 0.08, 0.08, -0.58, 0.01, 0],
-                     [-100, 0.05, 0.05, -0.58, 0.01, 0],
-                     [100, 0.05, 0.05, -0.25, -0.1, 0]]
+                m = [[100, 0.08, 0.08, -0.58, 0.01, 0, 0.03],
+                     [-100, 0.05, 0.05, -0.58, 0.01, 0, 0.03],
+                     [100, 0.05, 0.05, -0.25, -0.1, 0, 0.05]]
             elif type == 7:
                 # pins
-                m = [[100, 0.02, 0.025, -0.08, -0.03, 0],
-                     [100, 0.025, 0.025, -0.03, -0.25, 0],
-                     [100, 0.025, 0.025, -0.3, 0.25, 0],
-                     [100, 0.025, 0.025, -0.2, 0.25, 0]]
+                m = [[100, 0.02, 0.025, -0.08, -0.03, 0, 0.4],
+                     [100, 0.025, 0.025, -0.03, -0.25, 0, 0.4],
+                     [100, 0.025, 0.025, -0.3, 0.25, 0, 0.4],
+                     [100, 0.025, 0.025, -0.2, 0.25, 0, 0.4]]
 
-            x = x + phantom(m, n)
+            x = x + phantom(m, n, slices)
 
-            for index, value in np.ndenumerate(x):
-                if value > bone:
-                    x[index] = nmetal
+            x[x > bone] = nmetal
 
     # make sure the remainder is set to air
-    for index, value in np.ndenumerate(x):
-        if value == 0:
-            x[index] = air
+    x[x == 0] = air
 
-    x = np.flipud(x)
+    # flip each slice vertically
+    x = np.flip(x, axis=-2)
 
     return x
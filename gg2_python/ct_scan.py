@@ -2,11 +2,14 @@ import numpy as np
 import scipy
 from scipy import ndimage
 from ct_detect import ct_detect
+from fan_beam import fan_geometry, fan_scan_range
+from detector_response import detector_response, apply_detector_response
 import math
 import sys
 
 
-def ct_scan(photons, material, phantom, scale, angles, mas=10000):
+def ct_scan(photons, material, phantom, scale, angles, mas=10000, geometry=None, radius=None, fan_theta=None,
+            short_scan=False, crosstalk=None, scatter=None, scatter_width=None):
     """simulate CT scanning of an object
     scan = ct_scan(photons, material, phantom, scale, angles, mas) takes a phantom
     which contains indices relating to the attenuation coefficients given in
@@ -14,58 +17,249 @@ def ct_scan(photons, material, phantom, scale, angles, mas=10000):
     current-time product mas.
 
     scale is the pixel size of the input array phantom, in cm per pixel.
+
+    scan = ct_scan(photons, material, phantom, scale, angles, mas, geometry)
+    can be used to specify the scanning geometry. Possible options are:
+    'parallel' - parallel beams over 180 degrees (default)
+    'fan' - a fan beam from a point source, as in the Xtreme scanner. radius
+            is the distance from the source to the centre of rotation, in
+            samples, or fan_theta gives the fan angle instead, so that the
+            fan just covers the phantom (see fan_geometry). The angles cover
+            360 degrees, or only 180 degrees plus the fan angle if short_scan
+            is True. The samples lie on a flat detector through the centre of
+            rotation, so they are spaced in the same way as for 'parallel'.
+            Use fan_reconstruct to reconstruct these.
+
+    If phantom is a (slices x n x n) volume, from ct_phantom(..., slices), then
+    every slice is scanned together, sharing the rotated coordinates, and scan
+    is a (slices x angles x samples) sinogram volume.
+
+    crosstalk, scatter and scatter_width add blurring of the detections by
+    the detector and by scattered photons, as described in detector_response.
+    By default the detector is ideal.
+
+    photons can also be a family of sources (configurations x energies), such
+    as from fake_sources, when every source is scanned together and scan has
+    a leading configurations axis, for example (configurations x angles x
+    samples).
     """
 
+    n = max(phantom.shape[-2:])
+
+    # scan one angle at a time
+    if phantom.ndim == 3:
+        scan = np.zeros(np.shape(photons)[:-1] + (phantom.shape[0], angles, n))
+    else:
+        scan = np.zeros(np.shape(photons)[:-1] + (angles, n))
+    for rows, angle_indices in ct_scan_angles(photons, material, phantom, scale, angles, mas, geometry=geometry,
+                                              radius=radius, fan_theta=fan_theta, short_scan=short_scan,
+                                              crosstalk=crosstalk, scatter=scatter, scatter_width=scatter_width):
+        scan[..., angle_indices, :] = rows
+
+    sys.stdout.write("\n")
+
+    return scan
+
+
+def ct_scan_angles(photons, material, phantom, scale, angles, mas=10000, batch=1, order=None, geometry=None,
+                   radius=None, fan_theta=None, short_scan=False, crosstalk=None, scatter=None, scatter_width=None):
+    """simulate CT scanning of an object, a few angles at a time
+    for rows, angle_indices in ct_scan_angles(photons, material, phantom, scale, angles, mas, geometry=geometry,
+                                              radius=radius, fan_theta=fan_theta, short_scan=short_scan):
+    scans the phantom in the same way as ct_scan, but yields the detections as
+    they are produced, batch angles at a time. rows is (batch x samples) and
+    angle_indices gives the rows of the ct_scan output they correspond to.
+
+    order can give the sequence of angle indices to scan, for example
+    interleaved so that early batches cover the full 180 degrees. geometry,
+    radius, fan_theta, short_scan, crosstalk, scatter and scatter_width are as
+    for ct_scan. For a volume phantom, rows is (slices x batch x samples),
+    and for a family of sources rows has a leading configurations axis."""
+
+    if geometry is None:
+        geometry = 'parallel'
+    if geometry not in ['parallel', 'fan']:
+        raise ValueError('unknown scanning geometry ' + str(geometry))
+
     # find the coefficients for air
     air = material.name.index('Air')
 
     # get input image dimensions, and create a coordinate structure
-    n = max(phantom.shape)
+    n = max(phantom.shape[-2:])
+    if phantom.ndim == 3:
+        shape = (phantom.shape[0], n)
+    else:
+        shape = (n,)
+    configurations = np.shape(photons)[:-1]
     xi, yi = np.meshgrid(np.arange(n) - (n / 2), np.arange(n) - (n / 2))
 
     # check which materials phantom actually contains, and create single
-    # material phantoms for each of these, except for air
+    # material phantoms for each of these, except for air. These are cropped
+    # to the material's bounding box, so small inserts are cheap to project
     materials = []
     material_phantom = []
+    material_bounds = []
     for m in range(0, len(material.coeffs)):
-        z0 = (phantom == m).astype(int)
+        z0 = (phantom == m).astype(int if phantom.ndim == 2 else np.uint8)
         if (m != air) & (z0.sum() > 0):
             materials.append(m)
+            z0, bounds = _crop_material(z0)
             material_phantom.append(z0)
+            material_bounds.append(bounds)
 
-    # scan one angle at a time
-    scan = np.zeros((angles, n))
-    for angle in range(angles):
+    if geometry == 'fan':
 
-        sys.stdout.write("Scanning angle: %d   \r" % (angle + 1))
+        # source angle between each measurement
+        radius, fan_theta = fan_geometry(n, radius, fan_theta)
+        dbeta = fan_scan_range(fan_theta, short_scan) / angles
 
-        # Get rotated coordinates for interpolation
-        p = -math.pi / 2 - angle * math.pi / angles
-        x0 = xi * math.cos(p) - yi * math.sin(p) + (n / 2)
-        y0 = xi * math.sin(p) + yi * math.cos(p) + (n / 2)
+        # each ray runs from the source at distance radius, through the sample
+        # on a flat detector through the centre, with unit steps along the ray
+        # over the circle which contains the phantom
+        u = np.arange(n) - (n / 2)
+        gamma = np.arctan(u / radius)
+        steps = int(math.ceil(math.sqrt(2) * n)) + 1
+        length = radius * np.cos(gamma)[np.newaxis, :] + (np.arange(steps) - steps / 2)[:, np.newaxis]
+        ray_t = length * np.sin(gamma)[np.newaxis, :]
+        ray_s = length * np.cos(gamma)[np.newaxis, :] - radius
+    else:
+        dbeta = math.pi / angles
+        ray_t = xi
+        ray_s = yi
+        radius = None
+        gamma = None
 
-        # For each material, add up how many pixels contain this on each ray
-        depth = np.zeros((len(material.coeffs), n))
+    # detector blurring, the same for every row
+    response = None
+    if crosstalk or scatter:
+        response = detector_response(n, crosstalk, scatter, scatter_width)
 
-        for index, m in enumerate(materials):
-            interpolated = scipy.ndimage.map_coordinates(material_phantom[index], [y0, x0], order=1, mode='constant',
-                                                         prefilter=False)
-            depth[m] = np.sum(interpolated, axis=0)
+    if order is None:
+        order = range(angles)
+    order = np.asarray(order, dtype=int)
 
-        # only necessary for more complex forms of interpolation above
-        depth = np.clip(depth, 0, None)
+    for start in range(0, len(order), batch):
+        angle_indices = order[start:start + batch]
+        rows = np.zeros((len(angle_indices),) + configurations + shape)
 
-        # ensure an appropriate amount of air is included in the calculation
-        # to account for the scan being circular, but the phantom being square
-        # diameter of circle taken to be twice the phantom side length
-        depth[air] = 2 * n - np.sum(depth, axis=0)
+        for row, angle in enumerate(angle_indices):
 
-        # scale the depth appropriately and calculate detections for this set of
-        # materials
-        depth *= scale
+            sys.stdout.write("Scanning angle: %d   \r" % (angle + 1))
 
-        scan[angle] = ct_detect(photons, material.coeffs, depth, mas)
+            p = -math.pi / 2 - angle * dbeta
 
-    sys.stdout.write("\n")
+            # For each material, add up how many pixels contain this on each ray
+            depth = np.zeros((len(material.coeffs),) + shape)
 
-    return scan
+            for index, m in enumerate(materials):
+
+                # only the rays, and the steps along them, which can pass
+                # through this material's bounding box
+                bounds = material_bounds[index]
+                j0, j1, k0, k1 = _ray_block(bounds, p, n, ray_t.shape[0], radius, gamma)
+                if (j1 <= j0) or (k1 <= k0):
+                    continue
+
+                # Get rotated coordinates for interpolation, relative to the box
+                t = ray_t[j0:j1, k0:k1]
+                s = ray_s[j0:j1, k0:k1]
+                x0 = t * math.cos(p) - s * math.sin(p) + (n / 2) - bounds[-1][0]
+                y0 = t * math.sin(p) + s * math.cos(p) + (n / 2) - bounds[-2][0]
+
+                if phantom.ndim == 3:
+                    # round to whole pixels, as map_coordinates does for the integer masks
+                    interpolated = np.floor(_interpolate_slices(material_phantom[index], y0, x0) + 0.5)
+                    depth[m][bounds[0][0]:bounds[0][1], k0:k1] = np.sum(interpolated, axis=-2)
+                else:
+                    interpolated = scipy.ndimage.map_coordinates(material_phantom[index], [y0, x0], order=1,
+                                                                 mode='constant', prefilter=False)
+                    depth[m][k0:k1] = np.sum(interpolated, axis=-2)
+
+            # only necessary for more complex forms of interpolation above
+            depth = np.clip(depth, 0, None)
+
+            # ensure an appropriate amount of air is included in the calculation
+            # to account for the scan being circular, but the phantom being square
+            # diameter of circle taken to be twice the phantom side length
+            depth[air] = 2 * n - np.sum(depth, axis=0)
+
+            # scale the depth appropriately and calculate detections for this set of
+            # materials, for all slices and sources at once
+            depth *= scale
+
+            rows[row] = ct_detect(photons, material.coeffs, depth.reshape(len(material.coeffs), -1),
+                                  mas).reshape(configurations + shape)
+
+        if response is not None:
+            rows = apply_detector_response(rows, response)
+
+        # angles go just before the samples
+        rows = np.moveaxis(rows, 0, -2)
+
+        yield rows, angle_indices
+
+
+def _crop_material(mask):
+    """crop a single material phantom (rows x columns, or slices x rows x
+    columns) to its bounding box, with a border of one empty pixel in each
+    row and column where possible, so that interpolating the cropped mask
+    gives the same result as the whole mask. Returns the cropped mask and a
+    list of the (start, stop) index ranges along each dimension"""
+
+    bounds = []
+    for axis, index in enumerate(np.nonzero(mask)):
+        border = 0 if axis < mask.ndim - 2 else 1
+        bounds.append((max(int(index.min()) - border, 0), min(int(index.max()) + 1 + border, mask.shape[axis])))
+
+    return mask[tuple(slice(start, stop) for (start, stop) in bounds)], bounds
+
+
+def _ray_block(bounds, p, n, steps, radius=None, gamma=None):
+    """find the range of steps (j0 to j1) and rays (k0 to k1) which pass through
+    the box given by bounds at rotation p, for parallel rays or, if radius is
+    given, for fan rays at fan angles gamma"""
+
+    # corners of the box, relative to the centre
+    X = np.array([bounds[-1][0], bounds[-1][1] - 1, bounds[-1][0], bounds[-1][1] - 1]) - (n / 2)
+    Y = np.array([bounds[-2][0], bounds[-2][0], bounds[-2][1] - 1, bounds[-2][1] - 1]) - (n / 2)
+
+    # distance across (t) and along (s) the central ray
+    t = X * math.cos(p) + Y * math.sin(p)
+    s = -X * math.sin(p) + Y * math.cos(p)
+
+    if radius is None:
+        k0 = math.floor(t.min() + (n / 2))
+        k1 = math.ceil(t.max() + (n / 2)) + 1
+        j0 = math.floor(s.min() + (n / 2))
+        j1 = math.ceil(s.max() + (n / 2)) + 1
+    else:
+        # project onto the detector, and find the distance from the source
+        u = radius * t / (radius + s)
+        k0 = max(math.floor(u.min() + (n / 2)), 0)
+        k1 = min(math.ceil(u.max() + (n / 2)) + 1, n)
+        if k1 <= k0:
+            return 0, 0, 0, 0
+        centre = radius * np.cos(gamma[k0:k1])
+        j0 = math.floor(s.min() + radius - centre.max() + steps / 2)
+        j1 = math.ceil(np.sqrt(t ** 2 + (s + radius) ** 2).max() - centre.min() + steps / 2) + 1
+
+    return max(j0, 0), min(j1, steps), max(k0, 0), min(k1, n)
+
+
+def _interpolate_slices(volume, y0, x0):
+    """linearly interpolate every slice of volume (slices x rows x columns) at
+    the same coordinates y0 and x0, which are zero outside, in the same way as
+    map_coordinates does for a single slice. The weights are only found once
+    for all slices"""
+
+    rows, cols = volume.shape[1:]
+    inside = (y0 >= 0) & (y0 <= rows - 1) & (x0 >= 0) & (x0 <= cols - 1)
+
+    i0 = np.clip(np.floor(y0).astype(int), 0, rows - 2)
+    j0 = np.clip(np.floor(x0).astype(int), 0, cols - 2)
+    fy = np.clip(y0 - i0, 0, 1) * inside
+    fx = np.clip(x0 - j0, 0, 1)
+    gy = (1 - np.clip(y0 - i0, 0, 1)) * inside
+
+    return (volume[:, i0, j0] * (gy * (1 - fx)) + volume[:, i0, j0 + 1] * (gy * fx)
+            + volume[:, i0 + 1, j0] * (fy * (1 - fx)) + volume[:, i0 + 1, j0 + 1] * (fy * fx))
@@ -0,0 +1,72 @@
+import numpy as np
+import math
+from scipy import ndimage
+
+
+def denoise_sinogram(sinogram, counts, sigma=(1.0, 1.0), method=None, range_sigma=2.0):
+    """ y = denoise_sinogram(sinogram, counts, sigma, method, range_sigma)
+    reduces the photon noise in calibrated sinograms (... x angles x samples),
+    such as from ct_calibrate, before ramp_filter. counts is the number of
+    photons detected with nothing but air in the way, such as np.sum(photons)
+    for ct_scan, either one value or one for each sample.
+
+    Each sample is converted to the photons it was formed from, and these are
+    Anscombe transformed, so that the noise has a standard deviation of one
+    everywhere, however much the ray was attenuated. This is then smoothed
+    with separable kernels of standard deviation sigma (angles, samples), in
+    pixels, with 0 leaving that direction alone. Possible methods are:
+    'gaussian' - plain Gaussian smoothing
+    'bilateral' - each neighbour is also weighted by how close it is to the
+                  sample, with standard deviation range_sigma times the
+                  noise, so that edges are kept (default)
+
+    Every sinogram of the stack is filtered at once."""
+
+    if method is None:
+        method = 'bilateral'
+    if method not in ['gaussian', 'bilateral']:
+        raise ValueError('unknown denoising method ' + str(method))
+
+    sinogram = np.asarray(sinogram, dtype=float)
+    if sinogram.ndim < 2:
+        raise ValueError('input sinogram must be (... x angles x samples)')
+    sigma = np.broadcast_to(np.asarray(sigma, dtype=float), (2,))
+    counts = np.asarray(counts, dtype=float)
+
+    # photons detected at each sample, and their Anscombe transform
+    detected = counts * np.exp(-sinogram)
+    y = 2 * np.sqrt(detected + 0.375)
+
+    for axis, s in zip([-2, -1], sigma):
+        if s <= 0:
+            continue
+        if method == 'gaussian':
+            y = ndimage.gaussian_filter1d(y, s, axis=axis, mode='nearest')
+        else:
+            y = _bilateral_1d(y, s, range_sigma, axis)
+
+    # asymptotically unbiased inverse, keeping at least one photon as ct_detect does
+    detected = np.clip((y / 2) ** 2 - 0.125, 1, None)
+
+    return -np.log(detected / counts)
+
+
+def _bilateral_1d(y, sigma, range_sigma, axis):
+    """bilateral filter of y along axis, with Gaussian spatial standard
+    deviation sigma (pixels) and range standard deviation range_sigma,
+    repeating the end values beyond the edges"""
+
+    radius = int(math.ceil(3 * sigma))
+    y = np.moveaxis(y, axis, -1)
+    n = y.shape[-1]
+    padded = np.pad(y, [(0, 0)] * (y.ndim - 1) + [(radius, radius)], mode='edge')
+
+    total = np.zeros(y.shape)
+    weights = np.zeros(y.shape)
+    for k in range(-radius, radius + 1):
+        shifted = padded[..., radius + k:radius + k + n]
+        w = math.exp(-k * k / (2 * sigma * sigma)) * np.exp(-(shifted - y) ** 2 / (2 * range_sigma * range_sigma))
+        total += w * shifted
+        weights += w
+
+    return np.moveaxis(total / weights, -1, axis)
@@ -0,0 +1,64 @@
+import numpy as np
+import math
+
+# detector frequency responses, keyed by geometry and kernel settings
+DETECTOR_RESPONSE_CACHE = {}
+
+
+def detector_response(samples, crosstalk=None, scatter=None, scatter_width=None):
+    """ response = detector_response(samples, crosstalk, scatter, scatter_width)
+    returns the frequency response (for np.fft.rfft, zero-padded to at least
+    twice samples) of a detector of samples elements, for apply_detector_response.
+
+    crosstalk is the fraction of each element's photons which are detected
+    by each of its two neighbours. scatter is the fraction of the detected
+    photons, for a uniform beam, which are scattered, spread by a Gaussian
+    with standard deviation scatter_width samples (default samples / 4).
+    Both kernels keep a uniform beam unchanged, so ct_calibrate is not
+    affected. The response is formed once for each geometry and cached."""
+
+    crosstalk = 0.0 if crosstalk is None else float(crosstalk)
+    scatter = 0.0 if scatter is None else float(scatter)
+    if scatter_width is None:
+        scatter_width = samples / 4.0
+
+    if (crosstalk < 0) or (crosstalk > 0.5):
+        raise ValueError('crosstalk must be between 0 and 0.5')
+    if (scatter < 0) or (scatter >= 1):
+        raise ValueError('scatter must be between 0 and 1')
+
+    key = (samples, crosstalk, scatter, float(scatter_width))
+    if key not in DETECTOR_RESPONSE_CACHE:
+
+        # zero padded length, so the kernels do not wrap around
+        m = int(2 ** math.ceil(math.log(2 * samples, 2)))
+        f = np.fft.rfftfreq(m)
+
+        # three-point crosstalk kernel, and Gaussian scatter kernel
+        psf = (1 - 2 * crosstalk) + 2 * crosstalk * np.cos(2 * math.pi * f)
+        spread = np.exp(-2 * (math.pi * f * scatter_width) ** 2)
+
+        DETECTOR_RESPONSE_CACHE[key] = (1 - scatter) * psf + scatter * spread
+
+    return DETECTOR_RESPONSE_CACHE[key]
+
+
+def apply_detector_response(detections, response):
+    """ y = apply_detector_response(detections, response) blurs the detector
+    photons (... x samples), such as any stack of sinogram rows, by the
+    response from detector_response, using one FFT along the detector axis
+    for every row at once. Each row is extended by repeating its end values,
+    which are normally air, before it is convolved."""
+
+    detections = np.asarray(detections, dtype=float)
+    samples = detections.shape[-1]
+    m = 2 * (len(response) - 1)
+
+    # pad evenly either side, repeating the end values
+    before = (m - samples) // 2
+    pad = [(0, 0)] * (detections.ndim - 1) + [(before, m - samples - before)]
+    padded = np.pad(detections, pad, mode='edge')
+
+    blurred = np.fft.irfft(np.fft.rfft(padded, axis=-1) * response, n=m, axis=-1)
+
+    return blurred[..., before:before + samples]
@@ -0,0 +1,267 @@
+import collections
+import datetime
+import multiprocessing
+import os
+import sys
+import threading
+import time as timer
+from multiprocessing.connection import Listener, Client
+import pydicom
+from create_dicom import create_dicom
+from xtreme import Xtreme
+
+PORT = 8766
+
+# seconds run waits with no workers connected before giving up
+TIMEOUT = 60
+
+
+class XtremeCoordinator(object):
+    def __init__(self, rsq_file, file, method=None, alpha=None, nodes=1, address=None, authkey=None):
+        """c = XtremeCoordinator(rsq_file, file, method, alpha, nodes) prepares
+        a reconstruction of the Xtreme RSQ data which is shared between workers
+        on several nodes, each running xtreme_worker(c.address, authkey). The
+        output is the same series of DICOM files as
+        Xtreme(rsq_file).reconstruct_all(file, method, alpha), with a single
+        study UID, series UID and time, and frames numbered in the same order.
+
+        The coordinator only reads the RSQ header and writes the DICOM files.
+        The z-fans are split into nodes contiguous shards, one for each worker
+        as it connects. A worker which finishes its own shard steals z-fans
+        from the far end of the largest remaining shard, and the z-fan held by
+        a worker which disconnects is given to another, so slow or failed
+        nodes do not hold up the rest.
+
+        address is the (host, port) to listen on, defaulting to localhost on
+        PORT, so other nodes can only connect if an outside address such as
+        ('', PORT) is given. authkey (bytes) is used to check workers, since
+        messages from them are unpickled, and a random one is generated if it
+        is not given, as c.authkey. The workers must be able to read the RSQ
+        file, for example from a shared disk."""
+
+        if method is None:
+            method = 'parallel'
+        if method not in ['parallel', 'fan']:
+            raise ValueError('method must be parallel or fan for distributed reconstruction')
+
+        if address is None:
+            address = ('localhost', PORT)
+        if authkey is None:
+            authkey = os.urandom(32)
+
+        self.rsq_file = rsq_file
+        self.file = file
+        self.method = method
+        self.alpha = alpha
+        self.authkey = authkey
+        self.x = Xtreme(rsq_file)
+
+        # frame number of the first slice in each z-fan, as in reconstruct_all
+        self.first_frame = {}
+        z = 1
+        for fan in range(0, self.x.scans, self.x.fan_scans):
+            self.first_frame[fan] = z
+            z = z + len(self.x.fan_slices(fan))
+        self.frames = z - 1
+
+        fans = sorted(self.first_frame)
+        shard = -(-len(fans) // max(nodes, 1))
+        self.shards = [collections.deque(fans[i:i + shard]) for i in range(0, len(fans), shard)]
+        self.remaining = set(fans)
+        self.in_flight = {}
+        self.workers = 0
+        self.connected = 0
+        self.idle_since = timer.time()
+        self.condition = threading.Condition()
+
+        self.studyuid = pydicom.uid.generate_uid()
+        self.seriesuid = pydicom.uid.generate_uid()
+        self.time = datetime.datetime.now()
+
+        self.listener = Listener(address, authkey=authkey)
+        self.address = self.listener.address
+        self.closed = False
+
+    def run(self, timeout=None):
+        """frames = c.run(timeout) waits for the workers to reconstruct every
+        z-fan, writing each slice as it arrives, and returns the number of
+        frames. If no worker is connected for timeout seconds (default
+        TIMEOUT) while z-fans are left, RuntimeError is raised."""
+
+        if timeout is None:
+            timeout = TIMEOUT
+
+        accepter = threading.Thread(target=self.accept, daemon=True)
+        accepter.start()
+
+        try:
+            with self.condition:
+                while self.remaining:
+                    self.condition.wait(1.0)
+                    if self.remaining and self.connected == 0 and timer.time() - self.idle_since > timeout:
+                        raise RuntimeError('no workers connected for ' + str(timeout) + ' s with ' +
+                                           str(len(self.remaining)) + ' z-fans left')
+
+        finally:
+            self.closed = True
+            self.listener.close()
+            sys.stdout.write("\n")
+
+        return self.frames
+
+    def accept(self):
+        while True:
+            try:
+                connection = self.listener.accept()
+            except (OSError, EOFError, multiprocessing.AuthenticationError):
+                if self.closed:
+                    return
+                continue
+            threading.Thread(target=self.serve, args=(connection,), daemon=True).start()
+
+    def serve(self, connection):
+        """answer the requests of one worker until it is told it is done"""
+
+        with self.condition:
+            worker = self.workers
+            self.workers = self.workers + 1
+            self.connected = self.connected + 1
+            if worker >= len(self.shards):
+                self.shards.append(collections.deque())
+
+        try:
+            while True:
+                message = connection.recv()
+                if message[0] == 'hello':
+                    connection.send(('job', self.rsq_file, self.method, self.alpha))
+                    continue
+
+                if message[0] == 'result':
+                    self.save(message[1], message[2])
+
+                task = self.next_fan(worker)
+                connection.send(task)
+                if task[0] == 'done':
+                    break
+
+        except (OSError, EOFError):
+            pass
+
+        finally:
+            connection.close()
+
+            # give any unfinished z-fan to another worker
+            with self.condition:
+                self.connected = self.connected - 1
+                if self.connected == 0:
+                    self.idle_since = timer.time()
+                fan = self.in_flight.pop(worker, None)
+                if fan is not None and fan in self.remaining:
+                    self.shards[worker].appendleft(fan)
+                self.condition.notify_all()
+
+    def next_fan(self, worker):
+        """next z-fan for the worker, from its own shard or stolen from the
+        largest other shard"""
+
+        with self.condition:
+            self.in_flight.pop(worker, None)
+            if not self.remaining:
+                return ('done',)
+
+            if self.shards[worker]:
+                fan = self.shards[worker].popleft()
+            else:
+                largest = max(self.shards, key=len)
+                if not largest:
+                    # the rest are being reconstructed by other workers
+                    return ('wait',)
+                fan = largest.pop()
+
+            self.in_flight[worker] = fan
+
+            return ('fan', fan)
+
+    def save(self, fan, images):
+        """write the reconstructed slices of a z-fan as DICOM frames"""
+
+        with self.condition:
+            if fan not in self.remaining:
+                return
+
+        for i, Y in enumerate(images):
+            create_dicom(Y, self.file, self.x.scale, self.x.scale, self.first_frame[fan] + i,
+                         self.studyuid, self.seriesuid, self.time)
+
+        with self.condition:
+            self.remaining.discard(fan)
+            sys.stdout.write("Reconstructed z-fans: %d   \r" % (len(self.first_frame) - len(self.remaining)))
+            self.condition.notify_all()
+
+
+def xtreme_worker(address, authkey, rsq_file=None):
+    """ n = xtreme_worker(address, authkey) connects to the XtremeCoordinator
+    at address and reconstructs z-fans until there are none left, returning
+    the number of slices it reconstructed. authkey is the coordinator's, as
+    bytes or the hex string it prints. rsq_file can be given if the RSQ file
+    has a different path on this node."""
+
+    if not authkey:
+        raise ValueError('authkey is needed to connect to the coordinator')
+    if isinstance(authkey, str):
+        authkey = bytes.fromhex(authkey)
+
+    connection = Client(address, authkey=authkey)
+    slices = 0
+
+    try:
+        connection.send(('hello',))
+        job = connection.recv()
+        x = Xtreme(rsq_file if rsq_file is not None else job[1])
+        method = job[2]
+        alpha = job[3]
+
+        connection.send(('next',))
+        while True:
+            task = connection.recv()
+            if task[0] == 'done':
+                break
+
+            if task[0] == 'wait':
+                timer.sleep(0.1)
+                connection.send(('next',))
+                continue
+
+            fan = task[1]
+            images = [x.reconstruct_slice(scan, method, alpha) for scan in x.fan_slices(fan)]
+            slices = slices + len(images)
+            connection.send(('result', fan, images))
+
+    finally:
+        connection.close()
+
+    return slices
+
+
+def reconstruct_distributed(rsq_file, file, method=None, alpha=None, nodes=1, address=None, authkey=None, local_workers=0):
+    """ frames = reconstruct_distributed(rsq_file, file, method, alpha, nodes)
+    reconstructs the Xtreme RSQ data into the DICOM series file in the same
+    way as Xtreme.reconstruct_all, but shared between nodes workers which
+    each run xtreme_worker with the coordinator's address and authkey, which
+    is generated and printed if not given. local_workers worker processes can
+    also be started on this machine."""
+
+    coordinator = XtremeCoordinator(rsq_file, file, method, alpha, nodes, address, authkey)
+    print('Coordinator listening on ' + str(coordinator.address) + ' with authkey ' + coordinator.authkey.hex())
+
+    processes = [multiprocessing.Process(target=xtreme_worker, args=(coordinator.address, coordinator.authkey))
+                 for i in range(local_workers)]
+    for process in processes:
+        process.start()
+
+    frames = coordinator.run()
+
+    for process in processes:
+        process.join()
+
+    return frames
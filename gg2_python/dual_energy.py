@@ -0,0 +1,185 @@
+import numpy as np
+import hashlib
+import os
+import tempfile
+from scipy import interpolate, ndimage
+from ct_scan import ct_scan
+from ct_calibrate import ct_calibrate
+from ramp_filter import ramp_filter
+from back_project import back_project
+
+# where inversion tables are saved, and those already loaded
+TABLE_DIRECTORY = os.path.join(tempfile.gettempdir(), 'gg2_dual_energy')
+DUAL_ENERGY_TABLES = {}
+
+
+def dual_energy_table(low, high, material, basis=('Water', 'Bone'), max_length=None, size=256,
+                      storage_directory=None):
+    """ table = dual_energy_table(low, high, material, basis, max_length, size)
+    forms the table which converts pairs of calibrated attenuations, from scans
+    with the low and high energy source photons, into path lengths in cm
+    through the two basis materials (names in material). max_length gives the
+    longest path through each basis material covered by the table, which by
+    default is where the attenuation reaches 10.
+
+    The table is (size x size) over the range of both attenuations. It is
+    found once by evaluating the polychromatic attenuation over a fine grid of
+    path lengths, interpolating this back onto the table, and refining every
+    entry with a few Newton steps. Tables are saved in storage_directory
+    (default TABLE_DIRECTORY), under a hash of the spectra, basis materials and
+    settings, so each is only ever formed once.
+
+    table is [a_low, a_high, lengths], where a_low and a_high are the
+    attenuations along each axis of the table, and lengths is (2 x size x size)."""
+
+    if storage_directory is None:
+        storage_directory = TABLE_DIRECTORY
+
+    low = np.asarray(low, dtype=float)
+    high = np.asarray(high, dtype=float)
+    coeffs = np.stack([material.coeff(name) for name in basis])
+
+    if max_length is None:
+        # path length of each material for an attenuation of 10, at the low
+        # spectrum's mean energy
+        max_length = 10.0 / np.dot(coeffs, low / np.sum(low))
+    max_length = np.broadcast_to(np.asarray(max_length, dtype=float), (2,))
+
+    key = hashlib.sha256(low.tobytes() + high.tobytes() + coeffs.tobytes() + max_length.tobytes()
+                         + str(size).encode()).hexdigest()
+    if key in DUAL_ENERGY_TABLES:
+        return DUAL_ENERGY_TABLES[key]
+
+    full_path = os.path.join(storage_directory, 'dual_energy_' + key + '.npz')
+    if os.path.exists(full_path):
+        saved = np.load(full_path)
+        table = [saved['a_low'], saved['a_high'], saved['lengths']]
+
+    else:
+        table = _invert(low, high, coeffs, max_length, size)
+
+        if not os.path.exists(storage_directory):
+            os.makedirs(storage_directory)
+        temp = full_path + '.tmp.npz'
+        np.savez(temp, a_low=table[0], a_high=table[1], lengths=table[2])
+        os.replace(temp, full_path)
+
+    DUAL_ENERGY_TABLES[key] = table
+
+    return table
+
+
+def decompose_dual_energy(low_sinogram, high_sinogram, table):
+    """ [t1, t2] = decompose_dual_energy(low_sinogram, high_sinogram, table)
+    converts calibrated sinograms of the same object with the low and high
+    energy sources, of any matching shape, into path lengths in cm through
+    each basis material of the table from dual_energy_table. Every sample is
+    looked up at once by bilinear interpolation of the table."""
+
+    a_low, a_high, lengths = table
+    low_sinogram = np.asarray(low_sinogram, dtype=float)
+    high_sinogram = np.asarray(high_sinogram, dtype=float)
+    if low_sinogram.shape != high_sinogram.shape:
+        raise ValueError('input sinograms must be the same size')
+
+    # fractional index into the table of each sample
+    i = (low_sinogram - a_low[0]) / (a_low[1] - a_low[0])
+    j = (high_sinogram - a_high[0]) / (a_high[1] - a_high[0])
+    coordinates = [i.reshape(-1), j.reshape(-1)]
+
+    t1 = ndimage.map_coordinates(lengths[0], coordinates, order=1, mode='nearest', prefilter=False)
+    t2 = ndimage.map_coordinates(lengths[1], coordinates, order=1, mode='nearest', prefilter=False)
+
+    return t1.reshape(low_sinogram.shape), t2.reshape(low_sinogram.shape)
+
+
+def dual_energy_reconstruct(low, high, material, phantom, scale, angles, basis=('Water', 'Bone'), mas=10000,
+                            alpha=0.001):
+    """ [x1, x2] = dual_energy_reconstruct(low, high, material, phantom, scale, angles, basis)
+    scans the phantom with both the low and high energy source photons,
+    calibrates both sinograms, decomposes them into path lengths through the
+    two basis materials, and reconstructs each. x1 and x2 are the fraction of
+    each pixel which is equivalent to each basis material, so water is about
+    (1, 0) for a water and bone basis."""
+
+    table = dual_energy_table(low, high, material, basis)
+
+    low_sinogram = ct_calibrate(low, material, ct_scan(low, material, phantom, scale, angles, mas), scale)
+    high_sinogram = ct_calibrate(high, material, ct_scan(high, material, phantom, scale, angles, mas), scale)
+
+    t1, t2 = decompose_dual_energy(low_sinogram, high_sinogram, table)
+
+    # path lengths in cm reconstruct to fractions per cm of path
+    return back_project(ramp_filter(t1, scale, alpha)), back_project(ramp_filter(t2, scale, alpha))
+
+
+def _attenuation(photons, coeffs, lengths):
+    """calibrated attenuation, and its derivative with respect to each path
+    length, for the photons (energies) through lengths (2 x points) of the
+    materials with coefficients coeffs (2 x energies)"""
+
+    transmitted = photons[np.newaxis, :] * np.exp(-np.dot(lengths.T, coeffs))
+    total = np.sum(transmitted, axis=1)
+    attenuation = -np.log(total / np.sum(photons))
+    derivative = np.dot(transmitted, coeffs.T).T / total
+
+    return attenuation, derivative
+
+
+def _invert(low, high, coeffs, max_length, size, fine=129, iterations=5):
+    """form the inversion table for dual_energy_table"""
+
+    # energies with no photons in either spectrum make no difference
+    used = (low > 0) | (high > 0)
+    low = low[used]
+    high = high[used]
+    coeffs = coeffs[:, used]
+
+    # attenuations over a fine grid of path lengths
+    t1, t2 = np.meshgrid(np.linspace(0, max_length[0], fine), np.linspace(0, max_length[1], fine), indexing='ij')
+    lengths = np.stack([t1.reshape(-1), t2.reshape(-1)])
+    a1 = _attenuation(low, coeffs, lengths)[0]
+    a2 = _attenuation(high, coeffs, lengths)[0]
+
+    a_low = np.linspace(0, np.max(a1), size)
+    a_high = np.linspace(0, np.max(a2), size)
+    g1, g2 = np.meshgrid(a_low, a_high, indexing='ij')
+    targets = np.stack([g1.reshape(-1), g2.reshape(-1)])
+
+    # interpolate the path lengths back over the table, using the nearest
+    # point for attenuation pairs which no path lengths can give
+    points = np.stack([a1, a2], axis=1)
+    start = interpolate.griddata(points, lengths.T, targets.T, method='linear')
+    inside = ~np.any(np.isnan(start), axis=1)
+    start[~inside] = interpolate.griddata(points, lengths.T, targets.T[~inside], method='nearest')
+
+    # refine every entry with Newton steps, all at once, which also extends
+    # the table smoothly (with negative lengths) beyond the physical range.
+    # Steps are shortened until they reduce the error, so entries for
+    # attenuations far from any real object cannot diverge
+    t = start.T
+
+    def residual(t, targets):
+        f1, j1 = _attenuation(low, coeffs, t)
+        f2, j2 = _attenuation(high, coeffs, t)
+        return np.stack([f1 - targets[0], f2 - targets[1]]), np.stack([j1, j2])
+
+    with np.errstate(all='ignore'):
+        r, j = residual(t, targets)
+        for iteration in range(iterations):
+            det = j[0, 0] * j[1, 1] - j[0, 1] * j[1, 0]
+            det = np.where(np.abs(det) < 1e-12, 1e-12, det)
+            step = np.stack([(j[1, 1] * r[0] - j[0, 1] * r[1]) / det, (-j[1, 0] * r[0] + j[0, 0] * r[1]) / det])
+
+            pending = np.arange(t.shape[1])
+            for fraction in [1, 0.5, 0.25, 0.125]:
+                candidate = t[:, pending] - fraction * step[:, pending]
+                c, k = residual(candidate, targets[:, pending])
+                better = np.all(np.isfinite(c), axis=0) & (np.sum(c ** 2, axis=0) < np.sum(r[:, pending] ** 2, axis=0))
+                done = pending[better]
+                t[:, done] = candidate[:, better]
+                r[:, done] = c[:, better]
+                j[:, :, done] = k[:, :, better]
+                pending = pending[~better]
+
+    return [a_low, a_high, t.reshape((2, size, size))]
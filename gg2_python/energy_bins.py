@@ -0,0 +1,123 @@
+import numpy as np
+import copy
+import hashlib
+
+# compressed energy grids, keyed by spectrum, materials and error bound
+ENERGY_BINS_CACHE = {}
+
+
+def compress_energies(photons, material, materials=None, max_depth=20.0, tolerance=0.001):
+    """ [p, m] = compress_energies(photons, material, materials, max_depth, tolerance)
+    merges the energy bins of the source photons and material into a few
+    effective energies, so that ct_scan, ct_detect and ct_calibrate, given p
+    and m in place of photons and material, do far less work. Bins with no
+    photons are dropped, and neighbouring bins are merged for as long as the
+    detections through up to max_depth cm of the given materials (names or
+    indices, default all, with air always included) stay within a relative
+    error of tolerance.
+
+    p is the photons in each merged bin, and m is a copy of material whose
+    mev and coeffs are the photon-weighted mean energies and coefficients of
+    each merged bin. Coefficients of materials not listed are merged in the
+    same way, but their error is not checked. The result is cached, so calling
+    this again with the same spectrum and materials costs nothing."""
+
+    photons = np.asarray(photons, dtype=float)
+    if photons.ndim != 1 or len(photons) != material.coeffs.shape[1]:
+        raise ValueError('input photons must have the same number of energies as material')
+
+    if materials is None:
+        materials = range(len(material.name))
+    materials = sorted(set([material.name.index(m) if isinstance(m, str) else int(m) for m in materials]
+                           + [material.name.index('Air')]))
+
+    key = hashlib.sha256(photons.tobytes() + material.coeffs[materials].tobytes()
+                         + np.array(materials + [max_depth, tolerance], dtype=float).tobytes()).hexdigest()
+    if key not in ENERGY_BINS_CACHE:
+        ENERGY_BINS_CACHE[key] = energy_groups(photons, material.coeffs[materials], max_depth, tolerance)
+    groups = ENERGY_BINS_CACHE[key]
+
+    # merge every bin of the spectrum, energies and coefficients in each group
+    p = np.array([np.sum(photons[g]) for g in groups])
+    mev = np.array([np.dot(photons[g], material.mev[g]) for g in groups]) / p
+    coeffs = np.stack([np.dot(material.coeffs[:, g], photons[g]) for g in groups], axis=1) / p
+
+    compressed = copy.copy(material)
+    compressed.mev = mev
+    compressed.coeffs = coeffs
+
+    return p, compressed
+
+
+def energy_groups(photons, coeffs, max_depth=20.0, tolerance=0.001):
+    """ groups = energy_groups(photons, coeffs, max_depth, tolerance) finds the
+    groups of neighbouring energy bins (lists of bin indices) to merge, for
+    the source photons (energies) and coefficients coeffs (materials x
+    energies), as used by compress_energies.
+
+    The error is measured on test rays through each material alone at a range
+    of depths up to max_depth cm, and through random mixtures of them. Merging
+    starts from single bins, and repeatedly joins the pair of neighbouring
+    groups which gives the smallest worst-case relative error, until no
+    further pair can be joined without exceeding tolerance."""
+
+    depths = _test_depths(coeffs.shape[0], max_depth)
+
+    bins = np.nonzero(photons > 0)[0]
+    if len(bins) == 0:
+        raise ValueError('input photons has no non-zero energies')
+
+    # detections for every test ray using all the energies
+    exact = np.dot(photons[bins], np.exp(-np.dot(coeffs[:, bins].T, depths)))
+
+    def error(group):
+        """absolute error on each test ray from merging the group into one bin"""
+        p = photons[group]
+        total = np.sum(p)
+        exact_group = np.dot(p, np.exp(-np.dot(coeffs[:, group].T, depths)))
+        merged = total * np.exp(-np.dot(np.dot(coeffs[:, group], p) / total, depths))
+        return np.abs(exact_group - merged)
+
+    groups = [[b] for b in bins]
+    errors = [np.zeros(depths.shape[1]) for b in bins]
+    total = np.zeros(depths.shape[1])
+
+    # error from merging each neighbouring pair of groups
+    pairs = [error(groups[i] + groups[i + 1]) for i in range(len(groups) - 1)]
+
+    while pairs:
+        worst = [np.max((total + pairs[i] - errors[i] - errors[i + 1]) / exact) for i in range(len(pairs))]
+        i = int(np.argmin(worst))
+        if worst[i] > tolerance:
+            break
+
+        total = total + pairs[i] - errors[i] - errors[i + 1]
+        groups[i:i + 2] = [groups[i] + groups[i + 1]]
+        errors[i:i + 2] = [pairs[i]]
+
+        # only the pairs next to the new group change
+        del pairs[i]
+        if i > 0:
+            pairs[i - 1] = error(groups[i - 1] + groups[i])
+        if i < len(groups) - 1:
+            pairs[i] = error(groups[i] + groups[i + 1])
+
+    return groups
+
+
+def _test_depths(materials, max_depth, steps=16, mixtures=64):
+    """test rays (materials x rays) through each material alone, and through
+    random mixtures with a total depth of up to max_depth"""
+
+    single = np.linspace(0, max_depth, steps)
+    depths = [np.zeros((materials, 1))]
+    for m in range(materials):
+        d = np.zeros((materials, steps))
+        d[m] = single
+        depths.append(d)
+
+    rng = np.random.RandomState(0)
+    mix = rng.dirichlet(np.ones(materials), mixtures).T * rng.uniform(0, max_depth, mixtures)
+    depths.append(mix)
+
+    return np.concatenate(depths, axis=1)
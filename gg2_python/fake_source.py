@@ -1,6 +1,9 @@
 import numpy as np
 import math
 
+# families of sources, keyed by energies, configurations and filters
+FAKE_SOURCE_CACHE = {}
+
 
 def fake_source(mev, mvp, coeff=None, thickness=0, method='normal'):
     """ fake_source can generate typical CT X-ray source energies
@@ -16,36 +19,100 @@ def fake_source(mev, mvp, coeff=None, thickness=0, method='normal'):
     fake_source(mev, mvp, coeffs, thickness, 'ideal') creates output energies
     for an 'ideal' source with a very narrow energy range."""
 
-    # check for energies
-    energies = len(mev)
+    source = _spectra(np.asarray(mev, dtype=float), np.array([mvp], dtype=float), method)[0]
 
-    if method == 'ideal':
+    # add any additional metal filter
+    if coeff is not None:
+        source = source * np.exp(-coeff * thickness / 10)
+
+    return source
 
-        # single energy, at about the peak of the broader energy radiation
-        source = np.zeros(energies)
-        source[np.where(np.abs(mev - mvp * 0.7) < 0.001)] = 1e10
 
+def fake_sources(mev, mvp, filters=None, material=None, method='normal'):
+    """ y = fake_sources(mev, mvp, filters, material, method) generates a
+    whole family of sources at once, one for each configuration, as y
+    (configurations x energies), in the same way as fake_source.
+
+    mvp gives the maximum energy in MeV of each configuration. filters gives
+    the filter of each configuration, as a list of (name, thickness in mm)
+    pairs for any number of stacked materials from material (a Material, whose
+    mev must match mev), or None for no filter. For example
+
+        fake_sources(material.mev, [0.08, 0.1], [[('Aluminium', 2)],
+                     [('Aluminium', 1), ('Copper', 0.1)]], material)
+
+    Each family is cached, so sweeping the same configurations again costs
+    nothing. y can be given straight to ct_detect, ct_scan or ct_calibrate in
+    place of photons to handle every configuration together."""
+
+    mev = np.asarray(mev, dtype=float)
+    mvp = np.asarray(mvp, dtype=float).reshape(-1)
+    if filters is None:
+        filters = [None] * len(mvp)
+    if len(filters) != len(mvp):
+        raise ValueError('input filters must have one entry for each mvp')
+
+    # the stacked filter materials, and thickness (cm) of each for every configuration
+    filters = [tuple((name, float(t)) for (name, t) in f) if f is not None else () for f in filters]
+    names = sorted(set(name for f in filters for (name, t) in f))
+    if len(names) > 0:
+        if material is None:
+            raise ValueError('material is needed for filters')
+        if len(material.mev) != len(mev):
+            raise ValueError('input mev has different number of energies to material')
+        coeffs = np.stack([material.coeff(name) for name in names])
     else:
+        coeffs = np.zeros((0, len(mev)))
 
-        # experimental function to match expected form of source radiation
-        alpha = 100
-        sigma = mvp / 2
-        offset = -sigma
+    key = (method, mev.tobytes(), mvp.tobytes(), tuple(filters), coeffs.tobytes())
+    if key not in FAKE_SOURCE_CACHE:
+        thickness = np.zeros((len(mvp), len(names)))
+        for c, f in enumerate(filters):
+            for (name, t) in f:
+                thickness[c, names.index(name)] += t / 10
 
-        source = -(pow((mev - offset), 2)) / (2 * pow(sigma, 2))
+        FAKE_SOURCE_CACHE[key] = _spectra(mev, mvp, method) * np.exp(-np.dot(thickness, coeffs))
 
-        source = (1 / pow((2 * math.pi), 2)) * np.exp(source) * pow(np.abs(mev - offset), (1 / alpha))
+    return FAKE_SOURCE_CACHE[key].copy()
 
-        source[np.where(mev > mvp)] = 0
 
-        for index, value in np.ndenumerate(mev):
-            if source[index] != 0 and value > (0.8 * mvp):
-                source[index] = source[index] * pow((mvp - value) / (0.2 * mvp), .3)
+def source_configurations(mvps, filter_sets):
+    """ [mvp, filters] = source_configurations(mvps, filter_sets) lists every
+    combination of the maximum energies mvps with the filters in filter_sets
+    (each as for fake_sources), with the filters changing fastest, ready for
+    fake_sources(mev, mvp, filters, material)."""
 
-        source = source * 1.5e9
+    mvp = [m for m in mvps for f in filter_sets]
+    filters = [f for m in mvps for f in filter_sets]
 
-    # add any additional metal filter
-    if coeff is not None:
-        source = source * np.exp(-coeff * thickness / 10)
+    return mvp, filters
 
-    return source
+
+def _spectra(mev, mvp, method='normal'):
+    """unfiltered sources (configurations x energies) for the maximum
+    energies mvp (configurations), as for fake_source"""
+
+    mev = mev[np.newaxis, :]
+    mvp = mvp[:, np.newaxis]
+
+    if method == 'ideal':
+
+        # single energy, at about the peak of the broader energy radiation
+        return np.where(np.abs(mev - mvp * 0.7) < 0.001, 1e10, 0.0)
+
+    # experimental function to match expected form of source radiation
+    alpha = 100
+    sigma = mvp / 2
+    offset = -sigma
+
+    source = -(pow((mev - offset), 2)) / (2 * pow(sigma, 2))
+
+    source = (1 / pow((2 * math.pi), 2)) * np.exp(source) * pow(np.abs(mev - offset), (1 / alpha))
+
+    source = np.where(mev > mvp, 0, source)
+
+    # roll off towards the maximum energy
+    rolloff = (source != 0) & (mev > (0.8 * mvp))
+    source = np.where(rolloff, source * pow(np.clip(mvp - mev, 0, None) / (0.2 * mvp), .3), source)
+
+    return source * 1.5e9
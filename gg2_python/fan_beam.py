@@ -0,0 +1,145 @@
+import numpy as np
+import math
+import sys
+from ramp_filter import ramp_filter
+
+
+def fan_geometry(samples, radius=None, fan_theta=None):
+    """ [radius, fan_theta] = fan_geometry(samples, radius, fan_theta) completes
+    the fan-beam geometry from whichever of radius or fan_theta is given, in the
+    same way as the Xtreme header. radius is the distance from the X-ray source
+    to the centre of rotation, in samples, and fan_theta is the full fan angle
+    in radians, so that the fan just covers samples at the centre of rotation."""
+
+    if radius is None:
+        if fan_theta is None:
+            raise ValueError('one of radius or fan_theta must be given')
+        radius = (float(samples) / 2.0) / math.tan(float(fan_theta) / 2.0)
+    else:
+        fan_theta = 2.0 * math.atan((float(samples) / 2.0) / radius)
+
+    # the source must be outside the circle containing the phantom
+    if radius <= samples / math.sqrt(2):
+        raise ValueError('radius must be greater than samples / sqrt(2)')
+
+    return radius, fan_theta
+
+
+def fan_scan_range(fan_theta, short_scan=False):
+    """ r = fan_scan_range(fan_theta, short_scan) returns the range of source
+    angles, in radians, covered by a fan-beam scan. A full scan covers 360
+    degrees, and a short scan only 180 degrees plus the fan angle."""
+
+    if short_scan:
+        return math.pi + fan_theta
+    else:
+        return 2 * math.pi
+
+
+def fan_weight(sinogram, radius, short_scan=False, scan_range=None):
+    """ y = fan_weight(sinogram, radius, short_scan) weights the fan-beam
+    sinogram (angles x samples) ready for ramp filtering. Each ray is weighted
+    by the cosine of its fan angle, and also either by one half for a full
+    scan, where every ray is measured twice, or by Parker weights for a short
+    scan, which smoothly share each ray between its two measurements.
+
+    scan_range is the range of source angles in radians, which defaults to
+    that given by fan_scan_range."""
+
+    angles = sinogram.shape[0]
+    samples = sinogram.shape[1]
+    radius, fan_theta = fan_geometry(samples, radius)
+
+    if scan_range is None:
+        scan_range = fan_scan_range(fan_theta, short_scan)
+
+    # fan angle of each sample on the flat detector through the centre
+    u = np.arange(samples) - (samples / 2)
+    gamma = np.arctan(u / radius)
+
+    weights = np.tile(radius / np.sqrt(radius ** 2 + u ** 2), (angles, 1))
+
+    if short_scan:
+
+        # Parker weights, for source angles beta from 0 to pi + 2 * delta
+        beta = (np.arange(angles) * scan_range / angles)[:, np.newaxis]
+        delta = fan_theta / 2
+        tiny = np.finfo(float).tiny
+        parker = np.ones((angles, samples))
+        rising = beta < 2 * (delta - gamma)
+        falling = beta > math.pi - 2 * gamma
+        parker = np.where(rising, np.sin(math.pi / 4 * beta / np.maximum(delta - gamma, tiny)) ** 2, parker)
+        parker = np.where(falling, np.sin(math.pi / 4 * (math.pi + 2 * delta - beta)
+                                          / np.maximum(delta + gamma, tiny)) ** 2, parker)
+        parker = np.where(beta > math.pi + 2 * delta, 0, parker)
+        weights = weights * parker
+    else:
+        weights = weights / 2
+
+    return sinogram * weights
+
+
+def fan_back_project(sinogram, radius, scan_range, skip=1, start=0):
+    """fan_back_project back-projection to reconstruct fan-beam CT data
+    fan_back_project(sinogram, radius, scan_range) back-projects the weighted
+    and filtered fan-beam sinogram (angles x samples) to create the
+    reconstructed data (samples x samples), in the same way as back_project
+    does for parallel-beam data. radius is the distance from the source to the
+    centre of rotation in samples, and the angles are spread evenly over
+    scan_range radians, starting at source angle start."""
+
+    # get input dimensions
+    ns = sinogram.shape[1]
+    angles = sinogram.shape[0]
+    n = int(math.floor((ns - 1) // skip) + 1)
+    dbeta = scan_range / angles
+
+    # zero output and form input coordinates
+    # these have centre in the middle of the image
+    reconstruction = np.zeros((n, n))
+    xi, yi = np.meshgrid(np.arange(0, ns, skip) - (ns / 2), np.arange(0, ns, skip) - (ns / 2))
+
+    # back project over each angle in turn
+    for angle in range(angles):
+        sys.stdout.write("Reconstructing angle: %d   \r" % (angle + 1))
+
+        # distance of each pixel across (t) and along (s) the central ray,
+        # with the source at s = -radius, as in ct_scan
+        p = -math.pi / 2 - start - angle * dbeta
+        t = xi * math.cos(p) + yi * math.sin(p)
+        s = -xi * math.sin(p) + yi * math.cos(p)
+
+        # project onto the flat detector through the centre, and weight by the
+        # inverse square of the relative distance from the source
+        magnification = (radius + s) / radius
+        x0 = t / magnification + (ns / 2)
+
+        values = np.interp(x0, np.arange(ns), sinogram[angle], left=0, right=0)
+        reconstruction = reconstruction + values * (dbeta / magnification ** 2)
+
+    # ensure any data outside the reconstructed circle is set to invalid
+    reconstruction[np.where((xi ** 2 + yi ** 2) > (ns / 2) ** 2)] = -1
+
+    sys.stdout.write("\n")
+
+    return reconstruction
+
+
+def fan_reconstruct(sinogram, scale, radius, short_scan=False, alpha=0.001, skip=1, start=0):
+    """ fan_reconstruct filtered back-projection of fan-beam CT data
+    reconstruction = fan_reconstruct(sinogram, scale, radius, short_scan, alpha)
+    reconstructs the calibrated fan-beam sinogram (angles x samples) from
+    ct_scan(..., geometry='fan') directly, without rebinning to parallel beams.
+    scale is the sample size in cm, radius the source distance in samples,
+    and alpha the raised-cosine power for the ramp filter. short_scan must
+    match the scan, and start gives the source angle of the first row."""
+
+    samples = sinogram.shape[1]
+    radius, fan_theta = fan_geometry(samples, radius)
+    scan_range = fan_scan_range(fan_theta, short_scan)
+
+    weighted = fan_weight(sinogram, radius, short_scan, scan_range)
+
+    filtered = ramp_filter(weighted, scale, alpha)
+
+    return fan_back_project(filtered, radius, scan_range, skip, start)
@@ -0,0 +1,241 @@
+import numpy as np
+import math
+from scipy import ndimage, sparse
+
+
+def point_mtf(images, centre=None, size=32, scale=None):
+    """ [f, mtf] = point_mtf(images, centre, size, scale) measures the
+    modulation transfer function from reconstructions of a point, such as
+    ct_phantom type 2. images can be a single image (n x n) or any stack of
+    them (... x n x n). A size x size region around centre (row, column),
+    which defaults to the brightest pixel of each image, has its background
+    removed and is Fourier transformed, and the magnitude is normalised and
+    averaged around circles of equal frequency.
+
+    f is the frequency of each value in cycles per pixel, or in cycles per cm
+    if the pixel size scale (in cm) is given, and mtf is (... x len(f))."""
+
+    images = np.asarray(images, dtype=float)
+    stack = images.shape[:-2]
+    flat = images.reshape((-1,) + images.shape[-2:])
+
+    if centre is None:
+        peak = np.argmax(flat.reshape(len(flat), -1), axis=1)
+        rows, cols = np.unravel_index(peak, images.shape[-2:])
+    else:
+        rows = np.full(len(flat), int(centre[0]))
+        cols = np.full(len(flat), int(centre[1]))
+
+    # gather the region around each centre, repeating the edge pixels if needed
+    offsets = np.arange(size) - size // 2
+    r = np.clip(rows[:, np.newaxis] + offsets, 0, images.shape[-2] - 1)
+    c = np.clip(cols[:, np.newaxis] + offsets, 0, images.shape[-1] - 1)
+    region = flat[np.arange(len(flat))[:, np.newaxis, np.newaxis], r[:, :, np.newaxis], c[:, np.newaxis, :]]
+
+    # remove the background, taken from the border of the region
+    border = np.concatenate([region[:, 0], region[:, -1], region[:, 1:-1, 0], region[:, 1:-1, -1]], axis=1)
+    region = region - np.mean(border, axis=1)[:, np.newaxis, np.newaxis]
+
+    spectrum = np.abs(np.fft.fft2(region))
+    spectrum = spectrum / np.maximum(spectrum[:, :1, :1], np.finfo(float).tiny)
+
+    f = np.fft.fftfreq(size)
+    fy, fx = np.meshgrid(f, f, indexing='ij')
+    bins = np.round(np.sqrt(fx ** 2 + fy ** 2) * size).astype(int)
+    mtf = _radial_average(spectrum.reshape(len(flat), -1), bins.reshape(-1), size // 2 + 1)
+
+    f = np.arange(size // 2 + 1) / size
+    if scale is not None:
+        f = f / scale
+
+    return f, mtf.reshape(stack + (len(f),))
+
+
+def radial_profile(images, centre=None, spacing=0.25, radius=None):
+    """ [r, profile] = radial_profile(images, centre, spacing, radius) averages
+    each image of the stack (... x n x n) around circles about centre (row,
+    column), which defaults to the middle of the image as in ct_phantom. The
+    profile is oversampled with bins of spacing pixels out to radius, which
+    defaults to the edge of the image, so the edge of the ct_phantom type 1
+    circle gives an edge response for edge_mtf."""
+
+    images = np.asarray(images, dtype=float)
+    ny, nx = images.shape[-2:]
+    if centre is None:
+        centre = (ny / 2, nx / 2)
+    if radius is None:
+        radius = min(ny, nx) / 2
+
+    y, x = np.meshgrid(np.arange(ny) - centre[0], np.arange(nx) - centre[1], indexing='ij')
+    bins = np.floor(np.sqrt(x ** 2 + y ** 2) / spacing).astype(int).reshape(-1)
+    count = int(math.ceil(radius / spacing))
+
+    profile = _radial_average(images.reshape((-1, ny * nx)), bins, count)
+    r = (np.arange(count) + 0.5) * spacing
+
+    return r, profile.reshape(images.shape[:-2] + (count,))
+
+
+def edge_mtf(edge, spacing=1.0, scale=None):
+    """ [f, mtf] = edge_mtf(edge, spacing, scale) measures the modulation
+    transfer function from edge responses (... x samples) spaced by spacing
+    pixels, for example from radial_profile. Each edge response is
+    differentiated to give the line spread function, which is windowed and
+    Fourier transformed. f is in cycles per pixel, or per cm if scale is
+    given, and mtf is (... x len(f))."""
+
+    edge = np.asarray(edge, dtype=float)
+    lsf = np.diff(edge, axis=-1)
+    lsf = lsf * np.hanning(lsf.shape[-1])
+
+    spectrum = np.abs(np.fft.rfft(lsf, axis=-1))
+    mtf = spectrum / np.maximum(spectrum[..., :1], np.finfo(float).tiny)
+
+    f = np.fft.rfftfreq(lsf.shape[-1], spacing)
+    if scale is not None:
+        f = f / scale
+
+    return f, mtf
+
+
+def noise_power_spectrum(images, region=None, scale=None):
+    """ [f, nps, nps2] = noise_power_spectrum(images, region, scale) measures
+    the noise power spectrum from repeated noisy reconstructions of the same
+    object, images (... x realisations x n x n). The mean over the
+    realisations is removed, leaving just the noise, and the square region
+    (first row, first column, size) defaults to the middle half of the
+    image. All the regions are Fourier transformed together.
+
+    nps2 is the two-dimensional spectrum (... x size x size), with zero
+    frequency in the middle, and nps its average around circles of equal
+    frequency f, in cycles per pixel, or per cm if scale is given, when nps
+    is in units of the images squared times cm^2."""
+
+    images = np.asarray(images, dtype=float)
+    realisations = images.shape[-3]
+    if realisations < 2:
+        raise ValueError('at least two realisations are needed for the noise power spectrum')
+
+    ny, nx = images.shape[-2:]
+    if region is None:
+        size = min(ny, nx) // 2
+        region = ((ny - size) // 2, (nx - size) // 2, size)
+    r0, c0, size = region
+
+    noise = images[..., r0:r0 + size, c0:c0 + size]
+    noise = noise - np.mean(noise, axis=-3, keepdims=True)
+    noise = noise * math.sqrt(realisations / (realisations - 1.0))
+    noise = noise - np.mean(noise, axis=(-2, -1), keepdims=True)
+
+    pixel = 1.0 if scale is None else scale
+    nps2 = np.mean(np.abs(np.fft.fft2(noise)) ** 2, axis=-3) * (pixel ** 2) / (size * size)
+    nps2 = np.fft.fftshift(nps2, axes=(-2, -1))
+
+    f = np.fft.fftshift(np.fft.fftfreq(size))
+    fy, fx = np.meshgrid(f, f, indexing='ij')
+    bins = np.round(np.sqrt(fx ** 2 + fy ** 2) * size).astype(int)
+    nps = _radial_average(nps2.reshape((-1, size * size)), bins.reshape(-1), size // 2 + 1)
+
+    f = np.arange(size // 2 + 1) / float(size)
+    if scale is not None:
+        f = f / scale
+
+    return f, nps.reshape(nps2.shape[:-2] + (len(f),)), nps2
+
+
+def circle_uniformity(images, radius=None, roi=None):
+    """ [uniformity, cupping, noise] = circle_uniformity(images, radius, roi)
+    scores reconstructions (... x n x n) of the ct_phantom type 1 circle,
+    whose radius defaults to that of the phantom, 0.75 of the half-width.
+    Circular regions of radius roi (default radius / 8) are placed in the
+    middle and at 12, 3, 6 and 9 o'clock, at 3/4 of the radius.
+
+    uniformity is the largest difference between an outer region's mean and
+    the middle one, cupping is the relative drop from the mean of the outer
+    regions to the middle, and noise is the standard deviation in the middle
+    region. Each is of the size of the stack (...)."""
+
+    images = np.asarray(images, dtype=float)
+    ny, nx = images.shape[-2:]
+    if radius is None:
+        radius = 0.75 * min(ny, nx) / 2
+    if roi is None:
+        roi = radius / 8
+
+    y, x = np.meshgrid(np.arange(ny) - ny / 2, np.arange(nx) - nx / 2, indexing='ij')
+    offset = 0.75 * radius
+    centres = [(0, 0), (-offset, 0), (0, offset), (offset, 0), (0, -offset)]
+    masks = np.stack([((y - cy) ** 2 + (x - cx) ** 2) <= roi ** 2 for (cy, cx) in centres])
+    masks = masks.reshape((len(centres), -1)).astype(float)
+
+    flat = images.reshape((-1, ny * nx))
+    counts = np.sum(masks, axis=1)
+    means = np.dot(flat, masks.T) / counts
+    squares = np.dot(flat ** 2, masks.T) / counts
+
+    middle = means[:, 0]
+    outer = means[:, 1:]
+    uniformity = np.max(np.abs(outer - middle[:, np.newaxis]), axis=1)
+    edge = np.mean(outer, axis=1)
+    cupping = (edge - middle) / np.where(edge == 0, 1, edge)
+    noise = np.sqrt(np.maximum(squares[:, 0] - middle ** 2, 0))
+
+    stack = images.shape[:-2]
+
+    return uniformity.reshape(stack), cupping.reshape(stack), noise.reshape(stack)
+
+
+def streak_index(images, metal, reference=None, distance=(2, 20)):
+    """ s = streak_index(images, metal, reference, distance) scores streak
+    artefacts around metal in reconstructions (... x n x n). metal is a
+    boolean mask of the metal, such as phantom == material.name.index(metal),
+    either one for all the images or one for each. The score is taken over
+    the ring of pixels between distance[0] and distance[1] pixels from the
+    metal.
+
+    Without a reference this is the standard deviation of the ring. With a
+    reference, such as the reconstruction of the same phantom without metal,
+    it is the artefact index sqrt(|var(image) - var(reference)|) over the
+    ring. s is of the size of the stack (...)."""
+
+    images = np.asarray(images, dtype=float)
+    ny, nx = images.shape[-2:]
+    metal = np.asarray(metal, dtype=bool)
+
+    # distance of every pixel from the nearest metal pixel, for each mask
+    masks = metal.reshape((-1, ny, nx))
+    rings = np.stack([_ring(m, distance) for m in masks]).reshape(metal.shape).astype(float)
+    rings = np.broadcast_to(rings, images.shape)
+    counts = np.maximum(np.sum(rings, axis=(-2, -1)), 1)
+
+    def variance(x):
+        mean = np.sum(x * rings, axis=(-2, -1)) / counts
+        return np.sum(x ** 2 * rings, axis=(-2, -1)) / counts - mean ** 2
+
+    v = variance(images)
+    if reference is not None:
+        v = v - variance(np.broadcast_to(np.asarray(reference, dtype=float), images.shape))
+
+    return np.sqrt(np.abs(v))
+
+
+def _ring(mask, distance):
+    """pixels between distance[0] and distance[1] from the mask"""
+
+    if not np.any(mask):
+        return np.zeros(mask.shape, dtype=bool)
+
+    d = ndimage.distance_transform_edt(~mask)
+
+    return (d >= distance[0]) & (d <= distance[1])
+
+
+def _radial_average(values, bins, count):
+    """average of values (images x pixels) over the pixels in each of count
+    bins, given the bin of each pixel, ignoring those beyond the last bin"""
+
+    keep = np.nonzero(bins < count)[0]
+    counts = np.maximum(np.bincount(bins[keep], minlength=count), 1)
+    weights = sparse.csr_matrix((1.0 / counts[bins[keep]], (bins[keep], keep)), shape=(count, len(bins)))
+
+    return np.asarray(weights.dot(values.T)).T
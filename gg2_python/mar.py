@@ -0,0 +1,124 @@
+import numpy as np
+import math
+from scipy import ndimage
+from ramp_filter import ramp_filter
+from back_project import back_project
+
+# largest number of interpolated values formed at once by forward_project
+FORWARD_BLOCK = 1 << 22
+
+
+def forward_project(image, angles, scale=1.0):
+    """ sinogram = forward_project(image, angles, scale) sums the image
+    (n x n) along parallel rays to form a sinogram (angles x n), in the same
+    geometry used by back_project, so back_project(ramp_filter(sinogram))
+    gives the image back. scale is the pixel size, so that an attenuation
+    image gives an attenuation sinogram. Several angles are interpolated at
+    once, in blocks."""
+
+    n = image.shape[-1]
+    u = np.arange(n) - (n / 2)
+
+    # distance across (t) and along (s) each ray, for every pixel step
+    t = u[np.newaxis, :]
+    s = u[:, np.newaxis]
+
+    p = math.pi / 2 + np.arange(angles) * math.pi / angles
+    cos = np.cos(p)[:, np.newaxis, np.newaxis]
+    sin = np.sin(p)[:, np.newaxis, np.newaxis]
+
+    sinogram = np.zeros((angles, n))
+    block = max(1, FORWARD_BLOCK // (n * n))
+    for a in range(0, angles, block):
+        c = cos[a:a + block]
+        d = sin[a:a + block]
+        x0 = t * c + s * d + (n / 2)
+        y0 = -t * d + s * c + (n / 2)
+        values = ndimage.map_coordinates(image, [y0, x0], order=1, mode='constant', prefilter=False)
+        sinogram[a:a + block] = np.sum(values, axis=1)
+
+    return sinogram * scale
+
+
+def metal_trace(metal, angles):
+    """ trace = metal_trace(metal, angles) forward-projects the boolean metal
+    mask (n x n) and returns the sinogram samples (angles x n) whose rays pass
+    through it."""
+
+    return forward_project(metal.astype(float), angles) > 0.01
+
+
+def inpaint_sinogram(sinogram, trace):
+    """ y = inpaint_sinogram(sinogram, trace) replaces the samples of the
+    sinogram (... x samples) marked by trace by linear interpolation along
+    each row between the nearest unmarked samples either side. Samples with
+    no unmarked neighbour on one side take the value of the other side. All
+    the rows are filled at once."""
+
+    sinogram = np.asarray(sinogram, dtype=float)
+    trace = np.broadcast_to(trace, sinogram.shape)
+    samples = sinogram.shape[-1]
+    index = np.broadcast_to(np.arange(samples), sinogram.shape)
+
+    # index of the nearest good sample to the left and right of each sample
+    left = np.maximum.accumulate(np.where(trace, -1, index), axis=-1)
+    right = np.flip(np.minimum.accumulate(np.flip(np.where(trace, samples, index), axis=-1), axis=-1), axis=-1)
+
+    no_left = left < 0
+    no_right = right >= samples
+    left = np.where(no_left, right, left)
+    right = np.where(no_right, left, right)
+
+    # rows which are entirely metal are left unchanged
+    empty = no_left & no_right
+    left = np.where(empty, index, left)
+    right = np.where(empty, index, right)
+
+    low = np.take_along_axis(sinogram, left, axis=-1)
+    high = np.take_along_axis(sinogram, right, axis=-1)
+    fraction = (index - left) / np.maximum(right - left, 1)
+    filled = low + (high - low) * fraction
+
+    return np.where(trace & ~empty, filled, sinogram)
+
+
+def reduce_metal_artefacts(sinogram, scale, alpha=0.001, threshold=None, tissue=None):
+    """ [y, metal, first] = reduce_metal_artefacts(sinogram, scale, alpha, threshold, tissue)
+    reduces metal artefacts in the calibrated sinogram (angles x samples) with
+    normalised metal artefact reduction, ready for ramp_filter. A first
+    reconstruction, first, is segmented into metal, where it is above
+    threshold (default 2 /cm), and bone, air and soft tissue, which is set
+    to the value tissue (default the median of the pixels between 0.1 and 0.4
+    /cm). This prior is forward-projected and the sinogram is divided by it,
+    so that the samples whose rays pass through the metal can be inpainted
+    smoothly, before being multiplied back.
+
+    metal is the metal mask, where the first reconstruction should be put
+    back once the returned sinogram y has been reconstructed."""
+
+    if threshold is None:
+        threshold = 2.0
+
+    angles = sinogram.shape[0]
+    first = back_project(ramp_filter(sinogram, scale, alpha))
+
+    metal = first > threshold
+    if not np.any(metal):
+        return sinogram, metal, first
+
+    if tissue is None:
+        soft = (first > 0.1) & (first < 0.4)
+        tissue = np.median(first[soft]) if np.any(soft) else 0.2
+
+    # prior with flat soft tissue and air, keeping bone, and metal as tissue
+    prior = np.where(first < tissue / 2, 0, tissue)
+    prior = np.where((first > 1.5 * tissue) & ~metal, first, prior)
+    prior_sinogram = np.maximum(forward_project(prior, angles, scale), 0)
+
+    # a small offset keeps rays which miss the body from being amplified
+    prior_sinogram = prior_sinogram + 0.001
+
+    trace = metal_trace(metal, angles)
+    corrected = inpaint_sinogram(sinogram / prior_sinogram, trace) * prior_sinogram
+
+    return corrected, metal, first
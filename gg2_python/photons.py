@@ -43,7 +43,7 @@ def photons(original_energy, coeff, depth):
 
     # Make an array of attenuation coefficients for the depth given
 
-    attenuation = np.exp(-np.tile(coeff, (samples, 1)).transpose() * np.tile(depth, (energies, 1)))
+    attenuation = np.exp(-coeff[:, np.newaxis] * depth[np.newaxis, :])
 
     residual = original_energy * attenuation
 
@@ -1,21 +1,44 @@
 import math
 import numpy as np
-from matplotlib import pyplot as plt
 
+# scipy.fft can share each transform between several threads, but is only a
+# module from scipy 1.4, before which scipy.fft is numpy's fft function
+try:
+    import scipy.fft as fft_module
+except ImportError:
+    fft_module = None
+if not hasattr(fft_module, 'ifft'):
+    fft_module = None
 
-def ramp_filter(sinogram, scale, alpha=0.001):
+
+def ramp_filter(sinogram, scale, alpha=0.001, workers=None):
     """ Ram-Lak filter with raised-cosine for CT reconstruction
 
     fs = ramp_filter(sinogram, scale) filters the input in sinogram (angles x samples)
     using a Ram-Lak filter.
 
     fs = ramp_filter(sinogram, scale, alpha) can be used to modify the Ram-Lak filter by a
-    cosine raised to the power given by alpha."""
+    cosine raised to the power given by alpha.
+
+    fs = ramp_filter(sinogram, scale, alpha, workers) splits the FFTs between
+    workers threads."""
 
     # get input dimensions
-    angles = sinogram.shape[0]
     n = sinogram.shape[1]
-    max_freq = n
+
+    response = ramp_filter_response(n, scale, alpha)
+
+    print('Ramp filtering...')
+
+    return apply_ramp_filter(sinogram, response, workers)
+
+
+def ramp_filter_response(n, scale, alpha=0.001):
+    """ Ram-Lak filter frequency response
+
+    response = ramp_filter_response(n, scale, alpha) returns the filter used by
+    ramp_filter for sinograms with n samples, in FFT order. Its length is the
+    zero-padded FFT length, at least twice n."""
 
     # Set up filter to be at least as long as input
     m = np.floor(np.log(n) / np.log(2) + 2)
@@ -32,16 +55,30 @@ def ramp_filter(sinogram, scale, alpha=0.001):
     # Flip the filter halves to match how the FFT is produced (0->positive, negative->0)
     trunc_filter = np.concatenate((trunc_filter[int(m/2):], trunc_filter[0:int(m/2)]))
 
-    print(trunc_filter)
-    plt.plot(trunc_filter)
+    return trunc_filter
 
-    print('Ramp filtering...')
+
+def apply_ramp_filter(sinogram, response, workers=None):
+    """ fs = apply_ramp_filter(sinogram, response, workers) filters each row of sinogram
+    (angles x samples) by the frequency response from ramp_filter_response. As the
+    filter acts on each row separately, any subset of the angles can be filtered on
+    its own. The rows are split between workers threads if scipy.fft is available."""
+
+    # get input dimensions
+    n = sinogram.shape[1]
+    m = len(response)
 
     # FFT the current sinogram in the r direction for all angles, with zero padding to match filter length
-    current_fft = np.fft.fft(sinogram, axis=1, n=m)
+    if fft_module is not None:
+        current_fft = fft_module.fft(sinogram, axis=1, n=m, workers=workers)
+    else:
+        current_fft = np.fft.fft(sinogram, axis=1, n=m)
     # Apply the filter to all FFTs
-    filtered_fft = current_fft * trunc_filter[np.newaxis, :]
+    filtered_fft = current_fft * response[np.newaxis, :]
     # Invert the now filtered FFTs, setting the length back to the original input length
-    filtered_sinogram = np.fft.ifft(filtered_fft, axis=1)[:, :n]
+    if fft_module is not None:
+        filtered_sinogram = fft_module.ifft(filtered_fft, axis=1, workers=workers)[:, :n]
+    else:
+        filtered_sinogram = np.fft.ifft(filtered_fft, axis=1)[:, :n]
 
     return np.real(filtered_sinogram)
@@ -0,0 +1,144 @@
+import numpy as np
+import os
+from concurrent.futures import ThreadPoolExecutor
+import pydicom
+
+# upper HU limit of each material when segmenting, with the last unlimited
+SEGMENTATION = [(-500, 'Air'), (-30, 'Adipose'), (200, 'Soft Tissue'), (2000, 'Bone'), (None, 'Titanium')]
+
+# range of HU covered by the segmentation look-up table
+HU_MIN = -1024
+HU_MAX = 3071
+
+
+def dicom_series_files(files, workers=None):
+    """ files = dicom_series_files(files, workers) sorts a DICOM series into
+    slice order. files can be a list of file names or a directory, when every
+    .dcm file in it is used. Only the headers are read, in parallel, and the
+    slices are sorted by ImagePositionPatient along the slice normal, or by
+    SliceLocation if there is no position."""
+
+    if isinstance(files, str):
+        directory = files
+        files = [os.path.join(directory, f) for f in os.listdir(directory) if f.lower().endswith('.dcm')]
+    files = list(files)
+    if len(files) == 0:
+        raise ValueError('no DICOM files found')
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        locations = list(executor.map(_slice_location, files))
+
+    order = np.argsort(locations, kind='stable')
+
+    return [files[i] for i in order]
+
+
+def read_dicom_slice(file):
+    """ x = read_dicom_slice(file) reads one DICOM image, applying
+    RescaleSlope and RescaleIntercept so that CT images are in HU, as float32"""
+
+    ds = pydicom.dcmread(file, force=True)
+    slope = float(getattr(ds, 'RescaleSlope', 1))
+    intercept = float(getattr(ds, 'RescaleIntercept', 0))
+
+    return ds.pixel_array.astype(np.float32) * np.float32(slope) + np.float32(intercept)
+
+
+def stream_dicom_series(files, workers=None):
+    """ for x in stream_dicom_series(files, workers): yields each slice of the
+    DICOM series in order, in HU, reading up to workers slices ahead in
+    parallel, so the whole series is never held in memory. files is as for
+    dicom_series_files."""
+
+    files = dicom_series_files(files, workers)
+
+    # read ahead as many slices as there are threads
+    ahead = workers if workers is not None else min(32, (os.cpu_count() or 1) + 4)
+
+    with ThreadPoolExecutor(max_workers=ahead) as executor:
+        pending = [executor.submit(read_dicom_slice, f) for f in files[:ahead]]
+        for i in range(len(files)):
+            x = pending[0].result()
+            del pending[0]
+            if i + ahead < len(files):
+                pending.append(executor.submit(read_dicom_slice, files[i + ahead]))
+            yield x
+
+
+def read_dicom_series(files, workers=None):
+    """ x = read_dicom_series(files, workers) reads a whole DICOM series into
+    a (slices x rows x columns) volume in HU, as float32, loading the slices
+    in parallel. files is as for dicom_series_files."""
+
+    files = dicom_series_files(files, workers)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return np.stack(list(executor.map(read_dicom_slice, files)))
+
+
+def hu_to_material(x, names, segmentation=None):
+    """ labels = hu_to_material(x, names, segmentation) segments an image or
+    volume x in HU into indices of the material names (such as
+    Material().name), as uint8, so it can be used as a ct_scan phantom.
+    segmentation is a list of (upper HU, name) pairs in increasing order, with
+    None for the last, and defaults to SEGMENTATION. The labels are found
+    with a look-up table over every whole HU value."""
+
+    if segmentation is None:
+        segmentation = SEGMENTATION
+
+    return _apply_table(x, _segmentation_table(names, segmentation))
+
+
+def read_dicom_phantom(files, names, segmentation=None, workers=None):
+    """ phantom = read_dicom_phantom(files, names, segmentation, workers)
+    reads a DICOM series as a (slices x rows x columns) uint8 phantom of
+    indices into names, for ct_scan. Each slice is segmented by
+    hu_to_material as it is streamed in, so only the labels are kept."""
+
+    if segmentation is None:
+        segmentation = SEGMENTATION
+
+    lut = _segmentation_table(names, segmentation)
+    slices = [_apply_table(x, lut) for x in stream_dicom_series(files, workers)]
+
+    return np.stack(slices)
+
+
+def _segmentation_table(names, segmentation):
+    """uint8 label for each whole HU value from HU_MIN to HU_MAX"""
+
+    if len(names) > 256:
+        raise ValueError('too many materials for uint8 labels')
+
+    hu = np.arange(HU_MIN, HU_MAX + 1)
+    bounds = [limit for (limit, name) in segmentation[:-1]]
+    labels = np.array([names.index(name) for (limit, name) in segmentation], dtype=np.uint8)
+
+    return labels[np.searchsorted(bounds, hu, side='left')]
+
+
+def _apply_table(x, lut):
+    """look up the label of each value of x, rounded to the nearest HU"""
+
+    index = np.clip(np.floor(np.asarray(x) + 0.5), HU_MIN, HU_MAX).astype(np.int32) - HU_MIN
+
+    return lut[index]
+
+
+def _slice_location(file):
+    """position of a slice along the normal to its plane"""
+
+    ds = pydicom.dcmread(file, stop_before_pixels=True, force=True)
+
+    if 'ImagePositionPatient' in ds:
+        position = np.array(ds.ImagePositionPatient, dtype=float)
+        if 'ImageOrientationPatient' in ds:
+            orientation = np.array(ds.ImageOrientationPatient, dtype=float)
+            return float(np.dot(position, np.cross(orientation[:3], orientation[3:])))
+        return position[2]
+
+    if 'SliceLocation' in ds:
+        return float(ds.SliceLocation)
+
+    return float(getattr(ds, 'InstanceNumber', 0))
@@ -0,0 +1,224 @@
+import numpy as np
+import asyncio
+import hashlib
+import json
+import os
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from material import Material
+from source import Source
+from ct_phantom import ct_phantom
+from ct_scan import ct_scan
+from ct_calibrate import ct_calibrate
+from ramp_filter import ramp_filter_response, apply_ramp_filter
+from back_project import back_project
+from xtreme import Xtreme
+
+HOST = '127.0.0.1'
+PORT = 8765
+
+
+class ReconstructionService(object):
+    def __init__(self, cache_directory, workers=None):
+        """s = ReconstructionService(cache_directory, workers) creates a local
+        service which runs scan, reconstruct and RSQ conversion jobs on a pool
+        of workers threads. The Material and Source tables are loaded once, and
+        ramp filters are kept for each size of sinogram, so these costs are not
+        paid again for every job.
+
+        Each job is a dictionary, as sent to the service in JSON by submit_job:
+        {'job': 'scan', 'phantom': 3, 'samples': 256, 'scale': 0.1, 'angles': 256}
+            scans ct_phantom type 'phantom', with optional 'source' (index or
+            name in Source, default 0), 'mas' and 'metal', giving the sinogram
+        {'job': 'reconstruct', 'sinogram': FILE, 'scale': 0.1}
+            calibrates and reconstructs the sinogram saved in the .npy FILE, with
+            optional 'source', 'alpha', 'skip', 'method' and 'accuracy'
+        {'job': 'rsq', 'file': FILE}
+            converts the Xtreme RSQ FILE into DICOM, with optional 'method' and
+            'alpha' as for Xtreme.reconstruct_all
+
+        Results are saved in cache_directory under a hash of the job and the
+        contents of its input files, so a repeated job, or one identical to a
+        job still running, is answered without doing the work again. The result
+        is the .npy file for scan and reconstruct jobs, and the directory of
+        DICOM files for rsq jobs."""
+
+        self.cache_directory = cache_directory
+        if not os.path.exists(cache_directory):
+            os.makedirs(cache_directory)
+
+        self.material = Material()
+        self.source = Source()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.filters = {}
+        self.running = {}
+
+    async def submit(self, job):
+        """response = await s.submit(job) runs the job, or finds its result in
+        the cache, and returns a dictionary with 'status' of 'ok' and the
+        'result' file name, or 'status' of 'error' and a 'message'."""
+
+        # hashing the input files can take a while, so keep it off the event loop
+        loop = asyncio.get_running_loop()
+        try:
+            key = await loop.run_in_executor(self.executor, self.job_key, job)
+        except Exception as e:
+            return {'status': 'error', 'message': str(e)}
+
+        result = self.result_path(job, key)
+        if os.path.exists(result):
+            return {'status': 'ok', 'result': result, 'cached': True}
+
+        # share the work with an identical job which is already running
+        if key in self.running:
+            response = dict(await asyncio.shield(self.running[key]))
+            response['cached'] = True
+            return response
+
+        future = loop.create_future()
+        self.running[key] = future
+        response = {'status': 'error', 'message': 'job was cancelled'}
+        try:
+            await loop.run_in_executor(self.executor, self.run_job, job, result)
+            response = {'status': 'ok', 'result': result, 'cached': False}
+        except Exception as e:
+            response = {'status': 'error', 'message': str(e)}
+        finally:
+            # always answer any identical jobs waiting on this one, even if cancelled
+            del self.running[key]
+            future.set_result(response)
+
+        return response
+
+    def run_job(self, job, result):
+        """run the job on this thread, saving its output to result"""
+
+        kind = job['job']
+        photons = self.photons(job.get('source', 0))
+
+        if kind == 'scan':
+            phantom = ct_phantom(self.material.name, job['samples'], job['phantom'], job.get('metal', 'Titanium'))
+            output = ct_scan(photons, self.material, phantom, job['scale'], job['angles'], job.get('mas', 10000))
+
+        elif kind == 'reconstruct':
+            sinogram = np.load(job['sinogram'])
+            calibrated = ct_calibrate(photons, self.material, sinogram, job['scale'])
+            response = self.ramp_filter(sinogram.shape[1], job['scale'], job.get('alpha', 0.001))
+            filtered = apply_ramp_filter(calibrated, response)
+            output = back_project(filtered, job.get('skip', 1), job.get('method'), job.get('accuracy'))
+
+        elif kind == 'rsq':
+            temp = result + '.tmp'
+            if not os.path.exists(temp):
+                os.makedirs(temp)
+            Xtreme(job['file']).reconstruct_all(os.path.join(temp, 'slice'), job.get('method'), job.get('alpha'))
+            os.replace(temp, result)
+            return
+
+        # write to a temporary file first, so a partial result is never cached
+        temp = result + '.tmp.npy'
+        np.save(temp, output)
+        os.replace(temp, result)
+
+    def photons(self, source):
+        """source photons by index or name"""
+
+        if isinstance(source, str):
+            source = self.source.name.index(source)
+
+        return self.source.photons[source]
+
+    def ramp_filter(self, n, scale, alpha):
+        """ramp filter response for n samples, formed once and then reused"""
+
+        key = (n, scale, alpha)
+        if key not in self.filters:
+            self.filters[key] = ramp_filter_response(n, scale, alpha)
+
+        return self.filters[key]
+
+    def job_key(self, job):
+        """hash of the job and the contents of any input files"""
+
+        if job.get('job') not in ['scan', 'reconstruct', 'rsq']:
+            raise ValueError('unknown job ' + str(job.get('job')))
+
+        content = dict(job)
+        for field in ['sinogram', 'file']:
+            if field in content:
+                content[field] = file_hash(content[field])
+
+        return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+    def result_path(self, job, key):
+        if job['job'] == 'rsq':
+            return os.path.join(self.cache_directory, key)
+        else:
+            return os.path.join(self.cache_directory, key + '.npy')
+
+    async def handle_client(self, reader, writer):
+        """answer each line of JSON from a client with a line of JSON"""
+
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                job = json.loads(line.decode())
+            except ValueError:
+                response = {'status': 'error', 'message': 'job is not valid JSON'}
+            else:
+                response = await self.submit(job)
+            writer.write((json.dumps(response) + '\n').encode())
+            await writer.drain()
+
+        writer.close()
+
+    async def start(self, host=HOST, port=PORT):
+        """server = await s.start(host, port) starts listening for jobs on the
+        local socket, returning the asyncio server. Use port 0 to pick any free
+        port, which is then server.sockets[0].getsockname()[1]."""
+
+        return await asyncio.start_server(self.handle_client, host, port)
+
+    def serve_forever(self, host=HOST, port=PORT):
+        """s.serve_forever(host, port) runs the service until interrupted"""
+
+        async def serve():
+            server = await self.start(host, port)
+            async with server:
+                await server.serve_forever()
+
+        asyncio.run(serve())
+
+
+def file_hash(file_name):
+    """sha256 hash of the contents of a file"""
+
+    h = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+
+    return h.hexdigest()
+
+
+def submit_job(job, host=HOST, port=PORT):
+    """ response = submit_job(job, host, port) sends the job to a running
+    ReconstructionService and waits for the response, which has 'status' of
+    'ok' and the 'result' file name, or 'status' of 'error' and a 'message'."""
+
+    with socket.create_connection((host, port)) as connection:
+        connection.sendall((json.dumps(job) + '\n').encode())
+        reply = connection.makefile('r').readline()
+
+    if not reply:
+        raise ValueError('no response from service')
+
+    return json.loads(reply)
+
+
+if __name__ == '__main__':
+    import sys
+    cache = sys.argv[1] if len(sys.argv) > 1 else 'service_cache'
+    ReconstructionService(cache).serve_forever()
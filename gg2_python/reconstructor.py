@@ -0,0 +1,104 @@
+import numpy as np
+import math
+from ramp_filter import ramp_filter_response, apply_ramp_filter
+from back_project import back_project_angles
+from ct_calibrate import ct_calibrate
+
+
+class Reconstructor(object):
+    def __init__(self, angles, samples, scale, alpha=0.001, skip=1, method=None, accuracy=None):
+        """r = Reconstructor(angles, samples, scale, alpha) creates an incremental
+        reconstruction for a scan of angles x samples, where scale is the sample
+        size in cm and alpha is the raised-cosine power for the ramp filter,
+        which is passed on to ramp_filter_response, although like ramp_filter
+        this does not currently apply it.
+
+        Calibrated sinogram rows can then be added in any order and in batches of
+        any size with r.add_angles(rows, angle_indices), and r.reconstruction()
+        returns the image formed so far. Once every angle has been added this is
+        the same as back_project(ramp_filter(sinogram, scale, alpha), skip), and
+        the total cost is the same as reconstructing the whole sinogram at once,
+        since the ramp filter acts on each row separately. Raw detections,
+        such as the batches from ct_scan_angles, can be added with
+        r.add_detections(rows, angle_indices, photons, material).
+
+        skip, method and accuracy are passed on to back_project."""
+
+        self.angles = angles
+        self.samples = samples
+        self.scale = scale
+        self.skip = skip
+        self.method = method
+        self.accuracy = accuracy
+
+        # the filter only depends on the number of samples, so form it once
+        self.response = ramp_filter_response(samples, scale, alpha)
+
+        n = int(math.floor((samples - 1) // skip) + 1)
+        self.image = np.zeros((n, n))
+        self.received = np.zeros(angles, dtype=bool)
+
+    def add_angles(self, rows, angle_indices):
+        """r.add_angles(rows, angle_indices) filters and back-projects the
+        calibrated sinogram rows (len(angle_indices) x samples), which are the
+        given angle indices of the scan, and adds them to the image."""
+
+        angle_indices = np.asarray(angle_indices, dtype=int).reshape(-1)
+        rows = np.asarray(rows)
+        if rows.ndim == 1:
+            rows = rows.reshape((1, len(rows)))
+
+        if rows.shape != (len(angle_indices), self.samples):
+            raise ValueError('input rows must be (len(angle_indices) x ' + str(self.samples) + ')')
+        if np.any(angle_indices < 0) or np.any(angle_indices >= self.angles):
+            raise ValueError('angle index is not within range')
+        if np.any(self.received[angle_indices]) or len(np.unique(angle_indices)) != len(angle_indices):
+            raise ValueError('angle has already been added')
+
+        filtered = apply_ramp_filter(rows, self.response)
+        self.image += back_project_angles(filtered, angle_indices, self.angles, self.skip, self.method, self.accuracy)
+        self.received[angle_indices] = True
+
+    def add_detections(self, rows, angle_indices, photons, material):
+        """r.add_detections(rows, angle_indices, photons, material) calibrates
+        the detector rows (len(angle_indices) x samples) with ct_calibrate, for
+        the source photons and material they were scanned with, and adds them
+        as for add_angles. This lets ct_scan_angles feed the reconstruction
+        directly:
+
+            for rows, angle_indices in ct_scan_angles(photons, material, phantom, scale, angles, batch=8):
+                r.add_detections(rows, angle_indices, photons, material)"""
+
+        rows = np.asarray(rows)
+        if rows.ndim == 1:
+            rows = rows.reshape((1, len(rows)))
+
+        self.add_angles(ct_calibrate(photons, material, rows, self.scale), angle_indices)
+
+    def count(self):
+        """number of angles added so far"""
+
+        return int(np.sum(self.received))
+
+    def complete(self):
+        """True once every angle has been added"""
+
+        return bool(np.all(self.received))
+
+    def reconstruction(self):
+        """y = r.reconstruction() returns the image formed from the angles added
+        so far, scaled up by the fraction of angles missing so that partial
+        images have the same range of values as the final one."""
+
+        count = self.count()
+        if count == 0:
+            image = np.zeros(self.image.shape)
+        else:
+            image = self.image * (self.angles / count)
+
+        # ensure any data outside the reconstructed circle is set to invalid
+        coords = np.arange(0, self.samples, self.skip) - (self.samples / 2)
+        xi, yi = np.meshgrid(coords, coords)
+        image[np.where((xi ** 2 + yi ** 2) > (self.samples / 2) ** 2)] = -1
+
+        return image
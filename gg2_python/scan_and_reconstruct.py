@@ -1,17 +1,30 @@
+import numpy as np
 from ct_scan import ct_scan
 from ct_calibrate import ct_calibrate
 from ramp_filter import ramp_filter
 from back_project import back_project
+from mar import reduce_metal_artefacts
+from denoise import denoise_sinogram
 from hu import *
 
 
-def scan_and_reconstruct(photons, material, phantom, scale, angles, mas=10000, alpha=0.001):
+def scan_and_reconstruct(photons, material, phantom, scale, angles, mas=10000, alpha=0.001, mar=False, workers=None,
+                         denoise=None):
     """ Simulation of the CT scanning process
         reconstruction = scan_and_reconstruct(photons, material, phantom, scale, angles, mas, alpha)
         takes the phantom data in phantom (samples x samples), scans it using the
         source photons and material information given, as well as the scale (in cm),
         number of angles, time-current product in mas, and raised-cosine power
-        alpha for filtering. The output reconstruction is the same size as phantom."""
+        alpha for filtering. The output reconstruction is the same size as phantom.
+
+        If mar is True, metal artefacts are reduced in the calibrated sinogram
+        using reduce_metal_artefacts before filtering.
+
+        workers sets how many threads each slice is filtered and
+        back-projected with.
+
+        denoise can be 'gaussian' or 'bilateral' to reduce the noise in the
+        calibrated sinogram using denoise_sinogram before filtering."""
 
     # convert source (photons per (mas, cm^2)) to photons
 
@@ -21,11 +34,23 @@ def scan_and_reconstruct(photons, material, phantom, scale, angles, mas=10000, a
     # convert detector values into calibrated attenuation values
     calib_sinogram = ct_calibrate(photons, material, sinogram, scale)
 
+    # optionally smooth the photon noise, given the photons through air
+    if denoise is not None:
+        calib_sinogram = denoise_sinogram(calib_sinogram, np.sum(photons), method=denoise)
+
+    # optionally inpaint the rays through metal
+    if mar:
+        calib_sinogram, metal, first = reduce_metal_artefacts(calib_sinogram, scale, alpha)
+
     # Ram-Lak
-    calib_filtered_sinogram = ramp_filter(calib_sinogram, scale)
+    calib_filtered_sinogram = ramp_filter(calib_sinogram, scale, alpha, workers)
 
     # Back-projection
-    reconstruction = back_project(calib_filtered_sinogram)
+    reconstruction = back_project(calib_filtered_sinogram, workers=workers)
+
+    # put the metal back
+    if mar:
+        reconstruction[metal] = first[metal]
 
     # convert to Hounsfield Units
 
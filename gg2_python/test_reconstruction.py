@@ -1,8 +1,38 @@
 import unittest
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import zlib
 import numpy as np
 from matplotlib import pyplot as plt
 
+import ramp_filter as ramp_filter_module
 from ramp_filter import ramp_filter
+from back_project import back_project, back_project_roi, back_project_preview
+from reconstructor import Reconstructor
+from material import Material
+from source import Source
+from ct_phantom import ct_phantom
+from ct_scan import ct_scan, ct_scan_angles
+from ct_calibrate import ct_calibrate
+from chunked_array import ChunkedArray
+from ct_lib import save_chunked_array, load_chunked_array, save_draw_stack, save_montage, window_level
+from reconstruction_service import ReconstructionService
+from energy_bins import compress_energies
+from fake_source import fake_source, fake_sources, source_configurations
+from ct_detect import ct_detect
+from image_quality import point_mtf, noise_power_spectrum, circle_uniformity, streak_index
+from mar import inpaint_sinogram
+from denoise import denoise_sinogram
+from detector_response import detector_response, apply_detector_response
+import dual_energy
+from dual_energy import dual_energy_table, decompose_dual_energy
+from scan_and_reconstruct import scan_and_reconstruct
+from fan_beam import fan_reconstruct
+from create_dicom import create_dicom_series
+from read_dicom import read_dicom_series, read_dicom_phantom, stream_dicom_series
 
 
 class TestRamLak(unittest.TestCase):
@@ -13,5 +43,464 @@ class TestRamLak(unittest.TestCase):
         filter_test = ramp_filter(test_fft, 0.1, 2**k)
         self.assertSequenceEqual(list(filter_test[0]), list(filter_test[2**k-1]))
 
+
+class TestBackProject(unittest.TestCase):
+    def disc_sinogram(self, n):
+        """Sinogram of a centred disc, the same at every angle"""
+        t = np.arange(n) - n / 2
+        return np.tile(np.sqrt(np.clip((n / 3) ** 2 - t ** 2, 0, None)), (n, 1))
+
+    def test_hierarchical_matches_direct(self):
+        """Checks hierarchical back-projection without decimation matches the direct method"""
+        sinogram = self.disc_sinogram(64)
+        direct = back_project(sinogram)
+        fast = back_project(sinogram, method='hierarchical', accuracy=100)
+        self.assertTrue(np.allclose(direct, fast, atol=0.05))
+
+    def test_hierarchical_accuracy(self):
+        """Checks decimated hierarchical back-projection stays close to the direct method"""
+        sinogram = self.disc_sinogram(128)
+        direct = back_project(sinogram, 2)
+        fast = back_project(sinogram, 2, method='hierarchical')
+        self.assertEqual(direct.shape, fast.shape)
+        self.assertLess(np.abs(direct - fast).max(), 0.01 * np.abs(direct).max())
+
+    def test_roi_matches_full_image(self):
+        """Checks a region of interest matches the same pixels of the full reconstruction"""
+        sinogram = self.disc_sinogram(64)
+        full = back_project(sinogram)
+        roi = back_project_roi(sinogram, (-0.5 + 8, -0.5 - 4), 16, 16)
+        self.assertTrue(np.allclose(full[20:36, 32:48], roi))
+
+    def test_roi_pixel_size(self):
+        """Checks giving the pixel size chooses the matrix to cover the region"""
+        sinogram = self.disc_sinogram(64)
+        roi = back_project_roi(sinogram, (-0.5 + 8, -0.5 - 4), 16, pixel=2)
+        self.assertEqual(roi.shape, (8, 8))
+        self.assertTrue(np.allclose(roi, back_project_roi(sinogram, (-0.5 + 8, -0.5 - 4), 16, 8)))
+        self.assertTrue(np.allclose(back_project_roi(sinogram, (-0.5, -0.5), 64, pixel=1), back_project(sinogram)))
+
+    def test_roi_hierarchical_matches_direct(self):
+        """Checks hierarchical back-projection of a region matches the direct method inside the circle"""
+        sinogram = self.disc_sinogram(64)
+        direct = back_project_roi(sinogram, (4.5, -10.5), 40, 40)
+        fast = back_project_roi(sinogram, (4.5, -10.5), 40, 40, method='hierarchical', accuracy=100)
+        inside = direct >= 0
+        self.assertTrue(np.array_equal(inside, fast >= 0))
+        self.assertTrue(np.allclose(direct[inside], fast[inside], atol=0.05))
+
+    def test_preview_levels(self):
+        """Checks previews double in size each level, ending with the full region of interest"""
+        sinogram = self.disc_sinogram(64)
+        previews = list(back_project_preview(sinogram, (-0.5 + 8, -0.5 - 4), 32, 32, levels=3))
+        self.assertEqual([preview.shape for preview in previews], [(8, 8), (16, 16), (32, 32)])
+        self.assertTrue(np.allclose(previews[-1], back_project_roi(sinogram, (-0.5 + 8, -0.5 - 4), 32, 32)))
+
+        previews = list(back_project_preview(sinogram))
+        self.assertEqual(len(previews), 3)
+        self.assertTrue(np.allclose(previews[-1], back_project(sinogram)))
+
+    def test_threads_match_single_thread(self):
+        """Checks filtering and back-projection on several threads give the same image"""
+        raw = np.random.RandomState(0).rand(48, 64)
+        sinogram = ramp_filter(raw, 0.1)
+        self.assertTrue(np.allclose(sinogram, ramp_filter(raw, 0.1, workers=2)))
+
+        # older scipy has no scipy.fft module, when numpy.fft is used instead
+        module = ramp_filter_module.fft_module
+        try:
+            ramp_filter_module.fft_module = None
+            self.assertTrue(np.allclose(sinogram, ramp_filter(raw, 0.1, workers=2)))
+        finally:
+            ramp_filter_module.fft_module = module
+        for method in ['direct', 'hierarchical']:
+            single = back_project(sinogram, method=method)
+            threaded = back_project(sinogram, method=method, workers=3)
+            self.assertTrue(np.array_equal(single, threaded))
+
+
+class TestFanBeam(unittest.TestCase):
+    def test_fan_matches_parallel(self):
+        """Checks fan-beam scans reconstruct to the parallel-beam image, for full and short scans"""
+        material = Material()
+        photons = Source().photons[0]
+        phantom = ct_phantom(material.name, 64, 3)
+        parallel = back_project(ramp_filter(ct_calibrate(photons, material,
+                                                         ct_scan(photons, material, phantom, 0.1, 64), 0.1), 0.1))
+        inside = parallel >= 0
+        for short_scan in [False, True]:
+            scan = ct_scan(photons, material, phantom, 0.1, 128, geometry='fan', radius=200, short_scan=short_scan)
+            fan = fan_reconstruct(ct_calibrate(photons, material, scan, 0.1), 0.1, 200, short_scan)
+            self.assertEqual(fan.shape, parallel.shape)
+            self.assertLess(np.mean(np.abs(fan - parallel)[inside]), 0.1)
+            self.assertGreater(np.mean(np.abs(np.rot90(fan, 2) - parallel)[inside]), 0.15)
+
+
+class TestReconstructor(unittest.TestCase):
+    def test_batches_match_full_reconstruction(self):
+        """Checks angles added in batches, out of order, give the same image as a single reconstruction"""
+        rng = np.random.RandomState(0)
+        sinogram = rng.rand(24, 32)
+        full = back_project(ramp_filter(sinogram, 0.1), 2)
+
+        r = Reconstructor(24, 32, 0.1, skip=2)
+        order = rng.permutation(24)
+        for start in range(0, 24, 5):
+            self.assertFalse(r.complete())
+            r.add_angles(sinogram[order[start:start + 5]], order[start:start + 5])
+
+        self.assertTrue(r.complete())
+        self.assertTrue(np.allclose(full, r.reconstruction()))
+        self.assertRaises(ValueError, r.add_angles, sinogram[:1], [0])
+
+    def test_streamed_scan_matches_full_reconstruction(self):
+        """Checks interleaved batches streamed from ct_scan_angles give the same image as a whole scan"""
+        material = Material()
+        photons = Source().photons[0]
+        phantom = ct_phantom(material.name, 32, 3)
+        full = back_project(ramp_filter(ct_calibrate(photons, material, ct_scan(photons, material, phantom, 0.1, 24),
+                                                     0.1), 0.1))
+
+        r = Reconstructor(24, 32, 0.1)
+        order = np.concatenate([np.arange(i, 24, 4) for i in range(4)])
+        for rows, angle_indices in ct_scan_angles(photons, material, phantom, 0.1, 24, batch=5, order=order):
+            r.add_detections(rows, angle_indices, photons, material)
+
+        self.assertTrue(r.complete())
+        self.assertTrue(np.allclose(full, r.reconstruction()))
+
+
+class TestVolumeScan(unittest.TestCase):
+    def test_volume_matches_slices(self):
+        """Checks scanning a volume phantom gives the same sinograms as scanning each slice"""
+        material = Material()
+        photons = Source().photons[0]
+        volume = ct_phantom(material.name, 32, 7, slices=4)
+        self.assertEqual(volume.shape, (4, 32, 32))
+        self.assertTrue(np.array_equal(volume[2], ct_phantom(material.name, 32, 7)))
+
+        scan = ct_scan(photons, material, volume, 0.1, 8)
+        self.assertEqual(scan.shape, (4, 8, 32))
+        for s in range(4):
+            self.assertTrue(np.allclose(scan[s], ct_scan(photons, material, volume[s], 0.1, 8)))
+
+
+class TestChunkedArray(unittest.TestCase):
+    def test_round_trip(self):
+        """Checks chunked arrays read back the same slices with and without compression"""
+        rng = np.random.RandomState(0)
+        data = rng.randint(-1000, 3000, size=(5, 7, 9)).astype(np.int16)
+        with tempfile.TemporaryDirectory() as directory:
+            for compression in [None, 'zlib']:
+                name = 'volume_' + str(compression)
+                save_chunked_array(data, directory, name, chunks=(2, 3, 9), compression=compression, workers=2)
+                store = load_chunked_array(directory, name)
+                self.assertEqual(store.shape, data.shape)
+                self.assertEqual(store.dtype, data.dtype)
+                self.assertTrue(np.array_equal(store[:], data))
+                self.assertTrue(np.array_equal(store[3], data[3]))
+                self.assertTrue(np.array_equal(store[:, 4, 2:8], data[:, 4, 2:8]))
+
+                store[1:4, 2] = 7
+                data_copy = data.copy()
+                data_copy[1:4, 2] = 7
+                self.assertTrue(np.array_equal(store[:], data_copy))
+                self.assertEqual(store.missing_chunks(), [])
+
+    def test_recreate(self):
+        """Checks recreating an array keeps its chunks only if the layout is the same"""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'store')
+            for compression in [None, 'zlib']:
+                ChunkedArray(path, (4, 6), np.int16, compression=compression)[:] = 7
+                self.assertTrue(np.all(ChunkedArray(path, (4, 6), np.int16, compression=compression)[:] == 7))
+
+                store = ChunkedArray(path, (4, 3), np.float32, compression=compression)
+                self.assertTrue(np.array_equal(store[0], np.zeros(3, dtype=np.float32)))
+                self.assertEqual(len(store.missing_chunks()), 4)
+
+                # a chunk of the wrong size or type is refused rather than misread
+                wrong = np.ones((1, 5), dtype=np.int16)
+                if compression is None:
+                    np.save(store.chunk_file((1, 0)), wrong)
+                else:
+                    with open(store.chunk_file((1, 0)), 'wb') as f:
+                        f.write(zlib.compress(wrong.tobytes()))
+                self.assertRaises(ValueError, store.read_chunk, (1, 0))
+
+
+class TestImageExport(unittest.TestCase):
+    def test_stack_and_montage(self):
+        """Checks PNG stacks and montages read back with the window-levelled values and expected sheet sizes"""
+        data = np.random.RandomState(0).rand(5, 30, 40) * 2 - 0.5
+        with tempfile.TemporaryDirectory() as directory:
+            expected = window_level(data, [0, 1])
+            paths = save_draw_stack(data, directory, 'grey', caxis=[0, 1], workers=2)
+            self.assertEqual(len(paths), 5)
+            for i, path in enumerate(paths):
+                image = plt.imread(path)
+                self.assertEqual(image.shape, (30, 40))
+                self.assertTrue(np.array_equal(np.round(image * 255).astype(np.uint8), expected[i]))
+
+            paths = save_draw_stack(data, directory, 'colour', map='viridis')
+            lut = (plt.get_cmap('viridis')(np.arange(256))[:, :3] * 255 + 0.5).astype(np.uint8)
+            image = np.round(plt.imread(paths[2]) * 255).astype(np.uint8)
+            self.assertEqual(image.shape, (30, 40, 3))
+            self.assertTrue(np.array_equal(image, lut[window_level(data[2])[0]]))
+
+            paths = save_montage(data, directory, 'montage', caxis=[0, 1], columns=2)
+            sheets = [np.round(plt.imread(path) * 255).astype(np.uint8) for path in paths]
+            self.assertEqual([sheet.shape for sheet in sheets], [(60, 80), (30, 80)])
+            self.assertTrue(np.array_equal(sheets[0][30:, :40], expected[2]))
+            self.assertTrue(np.array_equal(sheets[1][:, :40], expected[4]))
+            self.assertFalse(np.any(sheets[1][:, 40:]))
+
+            self.assertEqual(save_montage(np.zeros((0, 30, 40)), directory, 'empty'), [])
+            self.assertEqual(save_draw_stack(np.zeros((0, 30, 40)), directory, 'empty'), [])
+
+
+class TestReconstructionService(unittest.TestCase):
+    def test_jobs_are_cached(self):
+        """Checks identical jobs over the local socket share one result, which matches running the steps directly"""
+        with tempfile.TemporaryDirectory() as directory:
+            service = ReconstructionService(directory, workers=2)
+            scan = {'job': 'scan', 'phantom': 1, 'samples': 32, 'scale': 0.1, 'angles': 16}
+
+            async def send(port, job):
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                writer.write((json.dumps(job) + '\n').encode())
+                response = json.loads((await reader.readline()).decode())
+                writer.close()
+                return response
+
+            async def run():
+                server = await service.start(port=0)
+                port = server.sockets[0].getsockname()[1]
+                first, second = await asyncio.gather(send(port, scan), send(port, scan))
+                reconstruct = {'job': 'reconstruct', 'sinogram': first['result'], 'scale': 0.1}
+                third = await send(port, reconstruct)
+                fourth = await send(port, reconstruct)
+                error = await send(port, {'job': 'unknown'})
+                server.close()
+                await server.wait_closed()
+                return first, second, third, fourth, error
+
+            first, second, third, fourth, error = asyncio.run(run())
+            self.assertEqual(first['status'], 'ok')
+            self.assertEqual(first['result'], second['result'])
+            self.assertEqual([first['cached'], second['cached']].count(True), 1)
+            self.assertFalse(third['cached'])
+            self.assertTrue(fourth['cached'])
+            self.assertEqual(error['status'], 'error')
+            self.assertEqual(len([f for f in os.listdir(directory) if f.endswith('.npy')]), 2)
+
+            sinogram = np.load(first['result'])
+            expected = ct_scan(service.source.photons[0], service.material,
+                               ct_phantom(service.material.name, 32, 1), 0.1, 16)
+            self.assertTrue(np.allclose(sinogram, expected))
+            self.assertEqual(np.load(third['result']).shape, (32, 32))
+
+    def test_cancelled_job_answers_duplicates(self):
+        """Checks an identical job waiting on a cancelled one is still answered"""
+        with tempfile.TemporaryDirectory() as directory:
+            service = ReconstructionService(directory, workers=2)
+            scan = {'job': 'scan', 'phantom': 1, 'samples': 16, 'scale': 0.1, 'angles': 8}
+            release = threading.Event()
+            run_job = service.run_job
+            service.run_job = lambda job, result: (release.wait(5), run_job(job, result))
+
+            async def run():
+                first = asyncio.ensure_future(service.submit(scan))
+                while not service.running:
+                    await asyncio.sleep(0.01)
+                second = asyncio.ensure_future(service.submit(scan))
+                await asyncio.sleep(0.1)
+                first.cancel()
+                response = await asyncio.wait_for(second, 5)
+                release.set()
+                return response
+
+            response = asyncio.run(run())
+            self.assertEqual(response['status'], 'error')
+            self.assertEqual(service.running, {})
+
+
+class TestEnergyBins(unittest.TestCase):
+    def test_compressed_scan(self):
+        """Checks scanning with merged energy bins stays within the error bound"""
+        material = Material()
+        photons = Source().photons[0]
+        phantom = ct_phantom(material.name, 32, 3)
+        p, m = compress_energies(photons, material, np.unique(phantom), 32 * 0.1 * 2, 0.001)
+        self.assertLess(len(p), 60)
+        self.assertEqual(m.coeffs.shape, (len(material.name), len(p)))
+        self.assertTrue(np.isclose(np.sum(p), np.sum(photons)))
+
+        full = ct_scan(photons, material, phantom, 0.1, 8)
+        compressed = ct_scan(p, m, phantom, 0.1, 8)
+        self.assertLessEqual(np.max(np.abs(compressed - full) / full), 0.001)
+
+
+class TestFakeSources(unittest.TestCase):
+    def test_family_matches_single_sources(self):
+        """Checks a family of filtered sources matches fake_source and detects as a batch"""
+        material = Material()
+        mvp, filters = source_configurations([0.08, 0.1], [None, [('Aluminium', 2)],
+                                                           [('Aluminium', 1), ('Copper', 0.1)]])
+        family = fake_sources(material.mev, mvp, filters, material)
+        self.assertEqual(family.shape, (6, len(material.mev)))
+        self.assertTrue(np.allclose(family[0], fake_source(material.mev, 0.08)))
+        self.assertTrue(np.allclose(family[4], fake_source(material.mev, 0.1, material.coeff('Aluminium'), 2)))
+        copper = fake_source(material.mev, 0.1, material.coeff('Aluminium'), 1) * \
+            np.exp(-material.coeff('Copper') * 0.01)
+        self.assertTrue(np.allclose(family[5], copper))
+
+        depth = np.array([[1.0, 2.0, 5.0], [0.0, 0.5, 1.0]])
+        coeffs = material.coeffs[[material.name.index('Water'), material.name.index('Bone')]]
+        detections = ct_detect(family, coeffs, depth)
+        self.assertEqual(detections.shape, (6, 3))
+        self.assertTrue(np.allclose(detections[5], ct_detect(family[5], coeffs, depth)))
+
+    def test_family_scan(self):
+        """Checks scanning and calibrating a family of sources matches each source on its own"""
+        material = Material()
+        phantom = ct_phantom(material.name, 16, 3)
+        family = fake_sources(material.mev, [0.08, 0.1], [None, [('Aluminium', 2)]], material)
+        scan = ct_scan(family, material, phantom, 0.1, 8)
+        calibrated = ct_calibrate(family, material, scan, 0.1)
+        self.assertEqual(scan.shape, (2, 8, 16))
+        self.assertEqual(calibrated.shape, (2, 8, 16))
+        for c in range(2):
+            single = ct_scan(family[c], material, phantom, 0.1, 8)
+            self.assertTrue(np.allclose(scan[c], single))
+            self.assertTrue(np.allclose(calibrated[c], ct_calibrate(family[c], material, single, 0.1)))
+
+
+class TestImageQuality(unittest.TestCase):
+    def test_metrics(self):
+        """Checks the metrics against a Gaussian point, white noise and a flat circle"""
+        y, x = np.mgrid[0:64, 0:64] - 32.0
+        sigma = np.array([1.0, 1.5])[:, np.newaxis, np.newaxis]
+        points = np.exp(-(x ** 2 + y ** 2) / (2 * sigma ** 2)) + 3
+        f, mtf = point_mtf(points)
+        self.assertEqual(mtf.shape, (2, len(f)))
+        self.assertTrue(np.allclose(mtf, np.exp(-2 * np.pi ** 2 * sigma[:, :, 0] ** 2 * f ** 2), atol=0.03))
+
+        rng = np.random.RandomState(0)
+        noise = rng.normal(0, 0.1, size=(3, 20, 64, 64))
+        f, nps, nps2 = noise_power_spectrum(noise, scale=0.1)
+        self.assertEqual(nps.shape, (3, len(f)))
+        self.assertTrue(np.allclose(np.mean(nps2, axis=(-2, -1)), 0.1 ** 2 * 0.1 ** 2, rtol=0.1))
+
+        circle = np.where(x ** 2 + y ** 2 < 24 ** 2, 1.0, 0.0)
+        uniformity, cupping, noise = circle_uniformity(np.stack([circle, circle * (1 + (x ** 2 + y ** 2) / 2000)]))
+        self.assertTrue(np.allclose([uniformity[0], cupping[0], noise[0]], 0))
+        self.assertGreater(cupping[1], 0.05)
+
+        metal = (x ** 2 + y ** 2) < 9
+        streaks = circle + 0.2 * np.sin(8 * np.arctan2(y, x))
+        index = streak_index(np.stack([circle, streaks]), metal, reference=circle)
+        self.assertAlmostEqual(index[0], 0)
+        self.assertGreater(index[1], 0.1)
+
+
+class TestMetalArtefactReduction(unittest.TestCase):
+    def test_inpaint(self):
+        """Checks marked samples are linearly interpolated along each row"""
+        sinogram = np.array([[1.0, 9, 9, 4, 5], [9, 9, 2, 3, 9]])
+        trace = sinogram == 9
+        self.assertTrue(np.allclose(inpaint_sinogram(sinogram, trace), [[1, 2, 3, 4, 5], [2, 2, 2, 3, 3]]))
+
+    def test_streaks_reduced(self):
+        """Checks MAR reduces streaks around a bilateral hip replacement"""
+        material = Material()
+        photons = Source().photons[0]
+        phantom = ct_phantom(material.name, 64, 4)
+        reference = scan_and_reconstruct(photons, material, ct_phantom(material.name, 64, 4, 'Soft Tissue'), 0.2, 64)
+        metal = phantom == material.name.index('Titanium')
+        before = scan_and_reconstruct(photons, material, phantom, 0.2, 64)
+        after = scan_and_reconstruct(photons, material, phantom, 0.2, 64, mar=True)
+        self.assertTrue(np.array_equal(before[metal], after[metal]))
+        self.assertLess(streak_index(after, metal, reference), streak_index(before, metal, reference))
+
+
+class TestDenoise(unittest.TestCase):
+    def test_noise_reduced(self):
+        """Checks both filters reduce Poisson noise in a whole stack of sinograms"""
+        n = 64
+        t = np.arange(n) - n / 2
+        clean = np.tile(0.02 * np.sqrt(np.clip((n / 3) ** 2 - t ** 2, 0, None)), (2, n, 1))
+        counts = 2000.0
+        detected = np.random.RandomState(0).poisson(counts * np.exp(-clean))
+        noisy = -np.log(np.clip(detected, 1, None) / counts)
+        for method in ['gaussian', 'bilateral']:
+            denoised = denoise_sinogram(noisy, counts, method=method)
+            self.assertEqual(denoised.shape, noisy.shape)
+            self.assertLess(np.std(denoised - clean), 0.5 * np.std(noisy - clean))
+        self.assertTrue(np.allclose(denoise_sinogram(noisy, counts, sigma=0), noisy, atol=1e-3))
+
+
+class TestDetectorResponse(unittest.TestCase):
+    def test_response(self):
+        """Checks detector blurring matches direct convolution and leaves a uniform beam unchanged"""
+        rows = np.ones((3, 40)) * 100
+        rows[:, 18:22] = 10
+        response = detector_response(40, crosstalk=0.1)
+        self.assertIs(response, detector_response(40, crosstalk=0.1))
+        expected = np.apply_along_axis(np.convolve, 1, np.pad(rows, ((0, 0), (1, 1)), mode='edge'), [0.1, 0.8, 0.1], 'valid')
+        self.assertTrue(np.allclose(apply_detector_response(rows, response), expected))
+
+        material = Material()
+        photons = Source().photons[0]
+        air = np.full((32, 32), material.name.index('Air'))
+        ideal = ct_scan(photons, material, air, 0.1, 4)
+        blurred = ct_scan(photons, material, air, 0.1, 4, crosstalk=0.05, scatter=0.2)
+        self.assertTrue(np.allclose(ideal, blurred))
+
+
+class TestDualEnergy(unittest.TestCase):
+    def test_decomposition(self):
+        """Checks path lengths are recovered from simulated attenuations, and tables are reused from disk"""
+        material = Material()
+        source = Source()
+        low = source.photons[4]
+        high = source.photons[0]
+        coeffs = np.stack([material.coeff('Water'), material.coeff('Bone')])
+        rng = np.random.RandomState(0)
+        lengths = np.stack([rng.uniform(0, 20, (10, 10)), rng.uniform(0, 3, (10, 10))])
+
+        def attenuation(photons):
+            return -np.log(np.sum(photons * np.exp(-np.tensordot(lengths, coeffs, axes=(0, 0))), axis=-1) / np.sum(photons))
+
+        with tempfile.TemporaryDirectory() as directory:
+            table = dual_energy_table(low, high, material, size=64, storage_directory=directory)
+            self.assertEqual(len(os.listdir(directory)), 1)
+            t1, t2 = decompose_dual_energy(attenuation(low), attenuation(high), table)
+            self.assertTrue(np.allclose(t1, lengths[0], atol=0.2))
+            self.assertTrue(np.allclose(t2, lengths[1], atol=0.1))
+
+            dual_energy.DUAL_ENERGY_TABLES.clear()
+            saved = dual_energy_table(low, high, material, size=64, storage_directory=directory)
+            self.assertTrue(np.array_equal(saved[2], table[2]))
+
+
+class TestReadDicom(unittest.TestCase):
+    def test_series_round_trip(self):
+        """Checks a series written by create_dicom_series reads back in order as HU and as a phantom"""
+        material = Material()
+        phantom = ct_phantom(material.name, 32, 3, slices=6).astype(np.uint8)
+        hu = np.zeros(phantom.shape)
+        for name, value in [('Air', -1000), ('Adipose', -100), ('Soft Tissue', 40), ('Bone', 1000), ('Titanium', 3000)]:
+            hu[phantom == material.name.index(name)] = value
+
+        with tempfile.TemporaryDirectory() as directory:
+            self.assertEqual(create_dicom_series(hu, 'volume', 0.5, storage_directory=directory, first=8), 6)
+            self.assertTrue(np.array_equal(read_dicom_series(directory, workers=3), hu))
+            self.assertTrue(np.array_equal(np.stack(list(stream_dicom_series(directory, workers=2))), hu))
+
+            labels = read_dicom_phantom(directory, material.name)
+            self.assertEqual(labels.dtype, np.uint8)
+            self.assertTrue(np.array_equal(labels, phantom))
+
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
@@ -0,0 +1,152 @@
+import unittest
+import os
+import math
+import tempfile
+import numpy as np
+import pydicom
+
+from xtreme import Xtreme
+from distributed_xtreme import reconstruct_distributed, XtremeCoordinator, xtreme_worker
+
+
+def write_rsq(filename, scans, angles, samples, skip_samples, data, fan_scans=None):
+    """Writes a small RSQ file with a resolution factor of 6, so that
+    skip_samples is 5 and skip_scans is 3, and data of
+    (scans x angles+2 x skip_samples+samples). fan_scans defaults to scans"""
+    if fan_scans is None:
+        fan_scans = scans
+    h = np.zeros(124, dtype=np.int32)
+    h[7] = samples + skip_samples
+    h[8] = angles + 2
+    h[9] = scans
+    h[14] = 100
+    h[19] = 6 * h[7]
+    h[20] = 6 * fan_scans
+    h[123] = 0
+    with open(filename, 'wb') as f:
+        f.write(b'CTDATA-HEADER_V1')
+        f.write(h.tobytes())
+        f.write(bytes(512 - 16 - 124 * 4))
+        f.write(data.astype(np.int16).tobytes())
+
+
+def write_disc_rsq(filename, angles, samples, centre, radius, mu):
+    """Writes a one-scan RSQ file as write_rsq, whose raw fan-beam data is
+    that of a disc of the given centre (x, y) and radius in samples, and
+    attenuation mu per sample, in the orientation of back_project"""
+    skip_angles = 2
+    fan_angles = 26
+    dtheta = math.pi / (angles - skip_angles - fan_angles)
+    fan_theta = dtheta * fan_angles
+    source = (samples / 2.0) / math.tan(fan_theta / 2.0)
+
+    # invert the raw detector positions used by Xtreme.fan_to_parallel to
+    # find the fan angle of each raw sample
+    atheta = fan_theta / 6
+    c = samples / 2 - 0.5
+    y = np.linspace(-fan_theta, fan_theta, 20001)
+    xo1 = source * np.sin(y) + samples / 2.0
+    xo = np.where(y > atheta, (xo1 - 5.0 * samples / 6.0) / np.cos(y - 2 * atheta) + c + samples / 3.0,
+                  np.where(y < -atheta, (xo1 - samples / 6.0) / np.cos(y + 2 * atheta) + c - samples / 3.0,
+                           (xo1 - samples / 2.0) / np.cos(y) + c))
+    gamma = np.interp(np.arange(samples), xo, y)
+
+    # parallel angle and offset of each raw ray
+    phi = np.arange(angles)[:, np.newaxis] - gamma / dtheta - skip_angles / 2.0 - fan_angles / 2.0 + 0.5
+    p = math.pi / 2 + phi * dtheta
+    t = source * np.sin(gamma) - (centre[0] * np.cos(p) - centre[1] * np.sin(p))
+    attenuation = 2 * mu * np.sqrt(np.clip(radius ** 2 - t ** 2, 0, None))
+
+    data = np.zeros((1, angles + 2, samples + 5))
+    data[:, 0] = 100
+    data[:, 1] = 30000
+    data[:, 2:, 5:] = 100 + 29900 * np.exp(-attenuation)
+    write_rsq(filename, 1, angles, samples, 5, np.round(data))
+
+
+class TestXtreme(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, 'test.rsq')
+        data = rng.randint(2000, 30000, size=(4, 82, 37))
+        data[:, 0] = rng.randint(50, 150, size=(4, 37))
+        data[:, 1] = 31000
+        write_rsq(self.filename, 4, 80, 32, 5, data)
+        self.x = Xtreme(self.filename)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_slices_match_single_slice(self):
+        """Checks the memory-mapped reader gives the same data as get_rsq_slice"""
+        Y, Ymin, Ymax = self.x.get_rsq_slices(1, 3)
+        Y1, Ymin1, Ymax1 = self.x.get_rsq_slice(2)
+        self.assertTrue(np.array_equal(Y[1], Y1))
+        self.assertTrue(np.array_equal(Ymin[1], Ymin1))
+        self.assertTrue(np.array_equal(Ymax[1], Ymax1))
+
+    def test_calibration(self):
+        """Checks both calibration methods match the float64 calculation"""
+        Y, Ymin, Ymax = self.x.get_rsq_slice(3)
+        expected = -np.log((Y - Ymin) / (Ymax.astype(float) - Ymin))
+        for method in ['lut', 'float32']:
+            out = np.zeros((4, 80, 32), dtype=np.float32)
+            X = self.x.calibrate_rsq_slices(0, 4, out, method, chunk=3)
+            self.assertIs(X, out)
+            self.assertTrue(np.allclose(X[3], expected, atol=1e-5))
+
+    def test_fan_matches_parallel(self):
+        """Checks fan-beam reconstruction of a slice matches rebinning to parallel beams, in the same orientation"""
+        filename = os.path.join(self.directory.name, 'disc.rsq')
+        write_disc_rsq(filename, 128, 64, (8, -5), 10, 0.08)
+        x = Xtreme(filename)
+        parallel = x.reconstruct_slice(0, 'parallel')
+        fan = x.reconstruct_slice(0, 'fan')
+        self.assertEqual(parallel.shape, fan.shape)
+
+        inside = (parallel >= 0) & (fan >= 0)
+        yi, xi = np.meshgrid(np.arange(64) - 32, np.arange(64) - 32, indexing='ij')
+        disc = ((xi - 8) ** 2 + (yi + 5) ** 2) < 8 ** 2
+        self.assertLess(np.mean(np.abs(parallel - fan)[inside]), 0.02 * np.mean(parallel[disc]))
+        self.assertGreater(np.mean(fan[disc]), 10 * np.mean(np.abs(fan[inside & ~disc])))
+
+    def test_distributed_matches_single_node(self):
+        """Checks sharded reconstruction on two worker processes gives the same DICOM series as reconstruct_all"""
+        rng = np.random.RandomState(1)
+        filename = os.path.join(self.directory.name, 'fans.rsq')
+        data = rng.randint(2000, 30000, size=(20, 82, 37))
+        data[:, 0] = rng.randint(50, 150, size=(20, 37))
+        data[:, 1] = 31000
+        write_rsq(filename, 20, 80, 32, 5, data, fan_scans=8)
+
+        single = os.path.join(self.directory.name, 'single')
+        Xtreme(filename).reconstruct_all(single)
+        shared = os.path.join(self.directory.name, 'shared')
+        frames = reconstruct_distributed(filename, shared, nodes=2, address=('localhost', 0), authkey=b'test', local_workers=2)
+
+        # three z-fans of 2, 2 and 1 slices
+        self.assertEqual(frames, 5)
+        series = set()
+        for z in range(1, frames + 1):
+            a = pydicom.dcmread(single + '_' + str(z).zfill(4) + '.dcm', force=True)
+            b = pydicom.dcmread(shared + '_' + str(z).zfill(4) + '.dcm', force=True)
+            self.assertEqual(a.PixelData, b.PixelData)
+            self.assertEqual(a.SliceLocation, b.SliceLocation)
+            series.add((b.StudyInstanceUID, b.SeriesInstanceUID))
+        self.assertEqual(len(series), 1)
+        self.assertFalse(os.path.exists(shared + '_' + str(frames + 1).zfill(4) + '.dcm'))
+
+    def test_coordinator_needs_workers_and_authkey(self):
+        """Checks the coordinator makes an authkey, refuses unauthenticated workers and gives up with none"""
+        coordinator = XtremeCoordinator(self.filename, os.path.join(self.directory.name, 'none'),
+                                        address=('localhost', 0))
+        self.assertEqual(coordinator.address[0], '127.0.0.1')
+        self.assertEqual(len(coordinator.authkey), 32)
+        with self.assertRaises(ValueError):
+            xtreme_worker(coordinator.address, None)
+        with self.assertRaises(RuntimeError):
+            coordinator.run(timeout=0.5)
+
+if __name__ == '__main__':
+    unittest.main()
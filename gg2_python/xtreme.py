@@ -7,6 +7,22 @@ import sys
 from ramp_filter import *
 from back_project import *
 from create_dicom import *
+from fan_beam import *
+from mar import *
+
+# log of every possible int16 difference, formed when first needed
+LOG_TABLE = None
+
+
+def _log_table():
+    """returns the log of 0 to 65535 as float32, with log(0) set to log(1)"""
+
+    global LOG_TABLE
+    if LOG_TABLE is None:
+        LOG_TABLE = np.log(np.maximum(np.arange(65536, dtype=np.float32), 1))
+
+    return LOG_TABLE
+
 
 class Xtreme(object):
     def __init__(self, file):
@@ -181,6 +197,101 @@ class Xtreme(object):
 
         return Y, Ymin, Ymax
 
+    def get_rsq_data(self):
+
+        """ D = get_rsq_data() memory-maps all of the raw data in the file,
+        without reading it. D is int16 of size (scans x angles+2 x
+        skip_samples+samples), where for each scan the first two rows are
+        Ymin and Ymax, followed by the sinogram rows, and the first
+        skip_samples of each row are invalid."""
+
+        if not self.okay:
+            print('File not opened correctly')
+            return
+
+        return np.memmap(self.filename, dtype=np.int16, mode='r', offset=(self.data_offset+1)*512,
+                         shape=(self.scans, self.angles+2, self.samples+self.skip_samples))
+
+    def get_rsq_slices(self, first, last):
+
+        """ [Y, Ymin, Ymax] = get_rsq_slices( F, L ) reads in slices F up to
+        (but not including) L from the file, as for get_rsq_slice, but
+        without conversion from int16. Y is (slices x angles x samples),
+        and Ymin and Ymax are (slices x samples)."""
+
+        if not self.okay:
+            print('File not opened correctly')
+            return
+
+        if (first < 0) or (last > self.scans) or (first >= last):
+            print('Scan is not within range')
+            return
+
+        D = self.get_rsq_data()[first:last, :, self.skip_samples:]
+
+        return D[:, 2:], D[:, 0], D[:, 1]
+
+    def calibrate_rsq_slices(self, first, last, out=None, method=None, chunk=None, angles=None):
+
+        """ X = calibrate_rsq_slices( F, L ) reads slices F up to (but not
+        including) L, and converts the detections Y into attenuation using
+        the dark field Ymin and flat field Ymax, as -log((Y-Ymin)/(Ymax-Ymin)).
+        X is float32 (slices x angles x samples).
+
+        calibrate_rsq_slices( F, L, OUT ) writes into the preallocated
+        float32 array OUT of the same size instead, which is also returned.
+
+        calibrate_rsq_slices( F, L, OUT, METHOD ) can be used to specify how
+        the logarithm is calculated. Possible options are:
+        'lut' - look up log(Y-Ymin) in a table of all 65536 possible
+                int16 values (default)
+        'float32' - calculate the logarithm directly, in float32
+
+        Differences Y-Ymin are limited to at least one, as for ct_detect.
+        The slices are worked through CHUNK at a time (default 8), so only
+        the output needs to fit in memory. ANGLES can give a (first, last)
+        range of angles, so that only those are read and calibrated."""
+
+        if angles is None:
+            angles = (0, self.angles)
+
+        if method is None:
+            method = 'lut'
+
+        if chunk is None:
+            chunk = 8
+
+        if method not in ['lut', 'float32']:
+            raise ValueError('unknown calibration method ' + str(method))
+
+        shape = (last - first, angles[1] - angles[0], self.samples)
+        if out is None:
+            out = np.empty(shape, dtype=np.float32)
+        elif (out.shape != shape) or (out.dtype != np.float32):
+            raise ValueError('output must be float32 of size ' + str(shape))
+
+        table = _log_table() if method == 'lut' else None
+
+        for start in range(first, last, chunk):
+            stop = min(start + chunk, last)
+            Y, Ymin, Ymax = self.get_rsq_slices(start, stop)
+            Y = Y[:, angles[0]:angles[1]]
+
+            # dark field and flat field terms, once per slice and detector
+            dark = Ymin.astype(np.int32)[:, np.newaxis, :]
+            flat = np.log(np.clip(Ymax.astype(np.float32) - Ymin, 1, None))[:, np.newaxis, :]
+
+            # detections less dark field, limited to the range of the table
+            d = np.clip(Y - dark, 1, 65535)
+
+            o = out[start-first:stop-first]
+            if table is not None:
+                np.subtract(flat, table[d.astype(np.uint16)], out=o)
+            else:
+                np.subtract(flat, np.log(d.astype(np.float32)), out=o)
+
+        return out
+
     def fan_to_parallel(self, X):
 
         """ Y = fan_to_parallel( X ) takes the raw sinogram in X (angles x
@@ -227,7 +338,108 @@ class Xtreme(object):
 
 
 
-    def reconstruct_all(self, file, method=None, alpha=None):
+    def fan_to_flat(self, X):
+
+        """ Y = fan_to_flat( X ) takes the raw sinogram in X (angles x
+        samples), whose samples lie on three detector arrays each covering
+        one third of the fan angle, and resamples each angle onto an
+        equivalent flat detector through the centre of rotation, as used by
+        ct_scan(..., geometry='fan') and fan_reconstruct. Unlike
+        fan_to_parallel, only the samples are interpolated, not the angles."""
+
+        samples = self.samples
+        atheta = self.fan_theta/6  # 1/6 of the fan angle
+        c = self.samples/2 - 0.5   # the centre sample
+
+        # fan angle of each flat detector sample. The raw samples run in the
+        # opposite direction to those of ct_scan, so flip the fan angle
+        y = np.arctan((samples/2.0 - np.arange(samples))/self.radius)
+        xo1 = self.radius*np.sin(y) + samples/2.0
+
+        # position on the raw detector arrays, as in fan_to_parallel
+        xo = np.where(y > atheta, (xo1-(5.0*samples/6.0))/np.cos(y-2.0*atheta) + c + samples/3.0,
+                      np.where(y < -atheta, (xo1-(samples/6.0))/np.cos(y+2.0*atheta) + c - samples/3.0,
+                               (xo1-(samples/2.0))/np.cos(y) + c))
+
+        # linearly interpolate every angle at once, with zero outside
+        i0 = np.floor(xo).astype(int)
+        f = xo - i0
+        a = np.where((i0 >= 0) & (i0 < samples), X[:, np.clip(i0, 0, samples-1)], 0)
+        b = np.where((i0+1 >= 0) & (i0+1 < samples), X[:, np.clip(i0+1, 0, samples-1)], 0)
+
+        return a + f*(b - a)
+
+    def fan_sinogram(self, scan, method=None):
+
+        """ [Y, start] = fan_sinogram( F ) reads and calibrates only the
+        angles of slice F which are needed for a short-scan fan-beam
+        reconstruction, covering 180 degrees plus the fan angle, and
+        converts them using fan_to_flat. Y is (recon_angles+fan_angles x
+        samples), and start is the source angle of the first row, in the
+        same convention as ct_scan, so that fan_reconstruct gives the same
+        orientation as fan_to_parallel and back_project. METHOD is as for
+        calibrate_rsq_slices."""
+
+        first = self.skip_angles//2
+        last = first + self.recon_angles + self.fan_angles
+
+        X = self.calibrate_rsq_slices(scan, scan+1, method=method, angles=(first, last))[0]
+
+        # the raw angles are centred on the parallel angles, and ct_scan has
+        # the source on the opposite side, hence the extra 180 degrees
+        start = (first - self.skip_angles/2.0 - self.fan_angles/2.0 + 0.5)*self.dtheta + math.pi
+
+        return self.fan_to_flat(X), start
+
+    def reconstruct_slice(self, scan, method=None, alpha=None, mar=False, workers=None):
+
+        """ Y = reconstruct_slice( F, METHOD, ALPHA ) reconstructs slice F of
+        the data, using the raised cosine power ALPHA to filter the data.
+        METHOD is as for reconstruct_all.
+
+        Y = reconstruct_slice( F, METHOD, ALPHA, MAR ) also reduces metal
+        artefacts using reduce_metal_artefacts if MAR is True, which needs
+        the 'parallel' method.
+
+        Y = reconstruct_slice( F, METHOD, ALPHA, MAR, WORKERS ) filters and
+        back-projects the 'parallel' method's slice on WORKERS threads."""
+
+        if alpha is None:
+            alpha = 0.001
+
+        if method is None:
+            method = 'parallel'
+
+        # pixel size in cm
+        scale = self.scale/10.0
+
+        if method == 'fan':
+            if mar:
+                raise ValueError('metal artefact reduction needs the parallel method')
+            X, start = self.fan_sinogram(scan)
+            return fan_reconstruct(X, scale, self.radius, True, alpha, 1, start)
+
+        X = self.calibrate_rsq_slices(scan, scan+1)[0]
+        Y = self.fan_to_parallel(X)
+        if mar:
+            Y, metal, first = reduce_metal_artefacts(Y, scale, alpha)
+        Y = ramp_filter(Y, scale, alpha, workers)
+        Y = back_project(Y, workers=workers)
+
+        if mar:
+            Y[metal] = first[metal]
+
+        return Y
+
+    def fan_slices(self, fan):
+
+        """ S = fan_slices( FAN ) lists the scans of the z-fan starting at
+        scan FAN which reconstruct_all reconstructs, leaving out the
+        skip_scans at each end which overlap the neighbouring z-fans."""
+
+        return [scan for scan in range(fan+self.skip_scans, fan+self.fan_scans-self.skip_scans) if scan < self.scans]
+
+    def reconstruct_all(self, file, method=None, alpha=None, mar=False):
         
         """ reconstruct_all( FILENAME, ALPHA ) creates a series of DICOM
         files for the Xtreme RSQ data. FILENAME is the base file name for
@@ -238,7 +450,12 @@ class Xtreme(object):
         specify how the data is reconstructed. Possible options are:
         'parallel' - reconstruct each slice separately using a fan to parallel
                            conversion
-        'fdk' - approximate FDK algorithm for better reconstruction"""
+        'fan' - reconstruct each slice separately using short-scan fan-beam
+                filtered back-projection, without the fan to parallel conversion
+        'fdk' - approximate FDK algorithm for better reconstruction
+
+        reconstruct_all( FILENAME, ALPHA, METHOD, MAR ) reduces metal
+        artefacts in each slice if MAR is True, as for reconstruct_slice."""
                 
         if alpha is None:
             alpha = 0.001
@@ -262,13 +479,14 @@ class Xtreme(object):
             else:
 
                 # default method should reconstruct each slice separately
-                for scan in range(fan+self.skip_scans,fan+self.fan_scans-self.skip_scans):
-                    if (scan<self.scans):
+                for scan in self.fan_slices(fan):
 
-						# reconstruct scan
+                    # reconstruct scan
+                    Y = self.reconstruct_slice(scan, method, alpha, mar)
 
-						# save as dicom file
-                        z = z + 1
+                    # save as dicom file
+                    create_dicom(Y, file, self.scale, self.scale, z, studyuid, seriesuid, time)
+                    z = z + 1
 
         return
 